@@ -86,7 +86,7 @@ class SafeAgent(CaptureAgent):
     maxValue = max(values)
     bestActions = [a for a,v in zip(actions, values) if v == maxValue]
 
-    return random.choice(bestActions)
+    return self.random.choice(bestActions)
 
   def getSuccessor(self, gameState, action):
     """
@@ -89,7 +89,7 @@ class ReflexCaptureAgent(CaptureAgent):
           bestDist = dist
       return bestAction
 
-    return random.choice(bestActions)
+    return self.random.choice(bestActions)
 
   def getSuccessor(self, gameState, action):
     """
@@ -0,0 +1,120 @@
+# benchmark.py
+# ------------
+# Licensing Information:  You are free to use or extend these projects for
+# educational purposes provided that (1) you do not distribute or publish
+# solutions, (2) you retain this notice, and (3) you provide clear
+# attribution to UC Berkeley, including a link to http://ai.berkeley.edu.
+#
+# Attribution Information: The Pacman AI projects were developed at UC Berkeley.
+# The core projects and autograders were primarily created by John DeNero
+# (denero@cs.berkeley.edu) and Dan Klein (klein@cs.berkeley.edu).
+# Student side autograding was added by Brad Miller, Nick Hay, and
+# Pieter Abbeel (pabbeel@cs.berkeley.edu).
+
+
+"""
+Measurements behind the engine's performance changes, so they can be
+reproduced (and compared across commits) with:
+
+  python benchmark.py -l defaultCapture -n 20000
+
+It reports the memory and time generateSuccessor takes, and the speed of
+GameState.toBytes/fromBytes (see capture.measureStateEncoding).
+"""
+
+import capture
+import layout
+import gc, random, sys, time
+
+def objectSize(obj):
+  "The bytes an object takes, with its __dict__ when it has one."
+  size = sys.getsizeof(obj)
+  if hasattr(obj, '__dict__'):
+    size += sys.getsizeof(obj.__dict__)
+  return size
+
+def measureSuccessors(layoutName = 'defaultCapture', numSuccessors = 20000, seed = 0):
+  """
+  Plays numSuccessors random moves with generateSuccessor, keeping every
+  state, and returns per successor: the bytes of newly allocated agent
+  states, configurations and positions, the gc-tracked objects allocated,
+  and the microseconds taken.  This is what __slots__ on AgentState and
+  Configuration cut down.
+  """
+  rand = random.Random(seed)
+  state = capture.GameState()
+  state.initialize(layout.getLayout(layoutName), 4)
+  state.data.timeleft = numSuccessors * 2
+  states = []
+  gc.collect()
+  objectsBefore = len(gc.get_objects())
+  start = time.time()
+  for step in range(numSuccessors):
+    agentIndex = step % 4
+    state = state.generateSuccessor(agentIndex, rand.choice(state.getLegalActions(agentIndex)))
+    states.append(state)
+  elapsed = time.time() - start
+  gc.collect()
+  objects = len(gc.get_objects()) - objectsBefore
+
+  seen = set()
+  size = 0
+  for state in states:
+    for agentState in state.data.agentStates:
+      for obj in (agentState, agentState.configuration, agentState.configuration.pos):
+        if id(obj) not in seen:
+          seen.add(id(obj))
+          size += objectSize(obj)
+  return {'bytes': size / float(numSuccessors),
+          'objects': objects / float(numSuccessors),
+          'microseconds': elapsed / numSuccessors * 1e6}
+
+def measureEncoding(layoutName = 'defaultCapture', numGames = 5, movesPerGame = 300, seed = 0):
+  """
+  Plays numGames random games of movesPerGame moves and times encoding
+  and decoding their states, and an observation from each game, with
+  capture.measureStateEncoding.
+  """
+  rand = random.Random(seed)
+  gameLayout = layout.getLayout(layoutName)
+  states = []
+  for i in range(numGames):
+    state = capture.GameState()
+    state.initialize(gameLayout, 4)
+    state.data.timeleft = movesPerGame * 4
+    for step in range(movesPerGame):
+      agentIndex = step % 4
+      state = state.generateSuccessor(agentIndex, rand.choice(state.getLegalActions(agentIndex)))
+      states.append(state)
+      if state.isOver(): break
+    states.append(state.makeObservation(0))
+  return capture.measureStateEncoding(states)
+
+def readCommand(argv):
+  from optparse import OptionParser
+  parser = OptionParser(usage = 'python benchmark.py <options>')
+  parser.add_option('-l', '--layouts', default = 'defaultCapture',
+                    help = 'Comma-separated layouts to measure on [Default: %default]')
+  parser.add_option('-n', '--numSuccessors', type = 'int', default = 20000,
+                    help = 'Number of random moves to make [Default: %default]')
+  parser.add_option('-s', '--seed', type = 'int', default = 0,
+                    help = 'Seed for the random moves [Default: %default]')
+  options, otherjunk = parser.parse_args(argv)
+  if len(otherjunk) != 0:
+    raise Exception('Command line input not understood: ' + str(otherjunk))
+  return options
+
+if __name__ == '__main__':
+  options = readCommand(sys.argv[1:])
+  for name in options.layouts.split(','):
+    if not name: continue
+    result = measureSuccessors(name, options.numSuccessors, options.seed)
+    print '%s, per successor:' % name
+    print '  agent/configuration/position bytes  %8.1f' % result['bytes']
+    print '  gc-tracked objects allocated        %8.1f' % result['objects']
+    print '  microseconds in generateSuccessor   %8.1f' % result['microseconds']
+    encoding = measureEncoding(name, seed = options.seed)
+    print '%s, states per second:' % name
+    for codec in ('bytes', 'cPickle'):
+      result = encoding[codec]
+      print '  %-8s encode %8.0f  decode %8.0f  (%.0f bytes each)' % (codec, result['encode'], result['decode'], result['size'])
@@ -56,11 +56,18 @@ from util import nearestPoint
 from util import manhattanDistance
 from game import Grid
 from game import Configuration
+from game import AgentState
 from game import Agent
 from game import reconstituteGrid
-import sys, util, types, time, random, imp
+from game import unpackGridBytes
+from game import PhaseTimes
+from game import zobristKey
+from game import agentZobristKey
+from game import foodZobristKey
+import sys, util, types, time, random, imp, struct
 import keyboardAgents
-import copy
+import collections
+import itertools
 import os
 
 # If you change these, you won't affect the server, so you can't cheat
@@ -74,11 +81,24 @@ MAX_MOVES = 600
 
 DUMP_FOOD_ON_DEATH = True # if we have the gameplay element that dumps dots on death
 
+COPY_ON_WRITE_SUCCESSORS = True # successors share untouched data with their parent
+
+WHOLE_STEP_MOVES = True # agents always move a whole cell, so positions stay on grid points
+
 SCARED_TIME = 40
 
-def scramble(configuration):
-  configuration.direction = random.choice(['North','South','East','West','Stop'])
-  configuration.pos = (configuration.pos[0]+random.randint(-2,2),configuration.pos[1]+random.randint(-2,2))
+# Events the rules publish to a game's EventBus (see CaptureRules)
+MoveEvent = collections.namedtuple('MoveEvent', 'agentIndex action position')
+FoodEatenEvent = collections.namedtuple('FoodEatenEvent', 'agentIndex position')
+CapsuleEatenEvent = collections.namedtuple('CapsuleEatenEvent', 'agentIndex position')
+DeathEvent = collections.namedtuple('DeathEvent', 'agentIndex position killerIndex')
+FoodDumpEvent = collections.namedtuple('FoodDumpEvent', 'agentIndex positions')
+FoodReturnedEvent = collections.namedtuple('FoodReturnedEvent', 'agentIndex numReturned scoreChange')
+GameEndEvent = collections.namedtuple('GameEndEvent', 'score reason')
+
+def scramble(configuration, rng = random):
+  configuration.direction = rng.choice(['North','South','East','West','Stop'])
+  configuration.pos = (configuration.pos[0]+rng.randint(-2,2),configuration.pos[1]+rng.randint(-2,2))
   return configuration
 ###################################################
 # YOUR INTERFACE TO THE PACMAN WORLD: A GameState #
@@ -110,19 +130,175 @@ class GameState:
     """
     Returns the successor state (a GameState object) after the specified agent takes the action.
     """
+    return self._generateSuccessor( agentIndex, action, None )
+
+  def generateSuccessors( self, agentIndex, wholeSteps = False ):
+    """
+    Returns a list of (action, successor) pairs, one for each legal action of
+    the agent, in the order given by getLegalActions.  The legal actions are
+    looked up once for all of the successors.
+
+    With wholeSteps, a successor that leaves the agent between grid points is
+    advanced again with the same action, like the second generateSuccessor
+    call in the agents' getSuccessor helpers.
+    """
+    legal = AgentRules.getLegalActions( self, agentIndex )
+    successors = []
+    for action in legal:
+      successor = self._generateSuccessor( agentIndex, action, legal )
+      if wholeSteps and not WHOLE_STEP_MOVES:
+        pos = successor.data.agentStates[agentIndex].getPosition()
+        if pos != nearestPoint( pos ):
+          successor = successor.generateSuccessor( agentIndex, action )
+      successors.append( (action, successor) )
+    return successors
+
+  def _generateSuccessor( self, agentIndex, action, legal ):
     # Copy current state
-    state = GameState(self)
+    state = GameState(self, copyOnWrite = COPY_ON_WRITE_SUCCESSORS)
+    state._applyRules( agentIndex, action, legal )
+    state.data.updateKey(self.data)
+    return state
 
+  def _applyRules( self, agentIndex, action, legal ):
     # Find appropriate rules for the agent
-    AgentRules.applyAction( state, action, agentIndex )
-    AgentRules.checkDeath(state, agentIndex)
-    AgentRules.decrementTimer(state.data.agentStates[agentIndex])
+    AgentRules.applyAction( self, action, agentIndex, legal )
+    AgentRules.checkDeath(self, agentIndex)
+    AgentRules.decrementTimer(self.data.getMutableAgentState(agentIndex))
 
     # Book keeping
-    state.data._agentMoved = agentIndex
-    state.data.score += state.data.scoreChange
-    state.data.timeleft = self.data.timeleft - 1
-    return state
+    self.data._agentMoved = agentIndex
+    self.data.score += self.data.scoreChange
+    self.data.timeleft -= 1
+
+  def apply( self, agentIndex, action ):
+    """
+    Makes the move in place, with the same rules as generateSuccessor, and
+    returns an undo record.  Passing the record to undo restores the state
+    exactly; records must be undone in reverse order of apply.
+
+    The move edits the state's own agent states, food grids and capsule
+    list, logging only the fields it changes, so walking a search tree
+    this way copies nothing.  The first apply, and the first apply or
+    undo after a successor, copy or observation was made from the state,
+    copy those objects once, so that no other state ever sees the edits.
+    Objects taken from the state directly, such as with getAgentState, do
+    see them.  The state keeps the log of the moves not yet undone.
+    """
+    data = self.data
+    if not data._undoOwned:
+      self._ownForUndo()
+    log = data._undoLog
+    record = len(log)
+    key = data.key()
+    score = data.score
+    log.append((score, data.scoreChange, data.timeleft, key, data._agentMoved,
+                data._foodEaten, data._foodAdded, data._capsuleEaten, data._win))
+
+    # Start from the per-move values a fresh successor would have
+    data._foodEaten = None
+    data._foodAdded = None
+    data._capsuleEaten = None
+    data._agentMoved = None
+    data._win = False
+    data.scoreChange = 0
+
+    data._applying = True
+    try:
+      self._applyRules( agentIndex, action, None )
+    except:
+      data._applying = False
+      self.undo( record )
+      raise
+    data._applying = False
+
+    # Update the key for what the move logged, as deriveKey does
+    agentKeys, owned = data._agentKeys, data._ownedAgents
+    food = None
+    for i in xrange(record + 1, len(log)):
+      entry = log[i]
+      kind = entry[0]
+      if kind == 'agent':
+        index = entry[1]
+        owned[index] = False
+        agentKey = agentZobristKey(index, data.agentStates[index])
+        key ^= agentKeys[index] ^ agentKey
+        agentKeys[index] = agentKey
+      elif kind == 'food':
+        if food is None: food = entry[1]
+      elif kind == 'capsule':
+        key ^= zobristKey(('capsule', entry[1]))
+    if food is not None:
+      key ^= foodZobristKey(data.food.bits ^ food)
+    if data.score != score:
+      key ^= zobristKey(('score', score)) ^ zobristKey(('score', data.score))
+    data._key = key
+    return record
+
+  def undo( self, record ):
+    """
+    Reverts the move that apply returned record for, and any made after it.
+    """
+    data = self.data
+    if not data._undoOwned:
+      self._ownForUndo()
+    log = data._undoLog
+    agentStates, agentKeys, owned = data.agentStates, data._agentKeys, data._ownedAgents
+    while len(log) > record + 1:
+      entry = log.pop()
+      kind = entry[0]
+      if kind == 'agent':
+        (kind, index, configuration, isPacman, scaredTimer, numCarrying, numReturned, agentKeys[index]) = entry
+        agentState = agentStates[index]
+        agentState.configuration = configuration
+        agentState.isPacman = isPacman
+        agentState.scaredTimer = scaredTimer
+        agentState.numCarrying = numCarrying
+        agentState.numReturned = numReturned
+        owned[index] = False
+      elif kind == 'food':
+        (kind, data.food.bits, data.redFood.bits, data.blueFood.bits,
+         data.redFoodCount, data.blueFoodCount) = entry
+      elif kind == 'carrying':
+        kind, isRed, carrying, returned = entry
+        if isRed:
+          data.redCarrying -= carrying
+          data.redReturned -= returned
+        else:
+          data.blueCarrying -= carrying
+          data.blueReturned -= returned
+      else:
+        (kind, position, index, data.redCapsules, data.blueCapsules) = entry
+        data.capsules.insert(index, position)
+    (data.score, data.scoreChange, data.timeleft, data._key, data._agentMoved,
+     data._foodEaten, data._foodAdded, data._capsuleEaten, data._win) = log.pop()
+
+  def _ownForUndo( self ):
+    """
+    Gives the state its own copies of what apply and undo edit in place.
+    """
+    data = self.data
+    data.key()
+    agentStates = data.agentStates
+    for i in range(len(agentStates)):
+      agentStates[i] = agentStates[i].copy()
+    data._ownedAgents = [False] * len(agentStates)
+    data.food = data.food.copy()
+    data.redFood = data.redFood.copy()
+    data.blueFood = data.blueFood.copy()
+    data.capsules = data.capsules[:]
+    data._ownsCapsules = True
+    if data._undoLog is None:
+      data._undoLog = []
+    data._undoOwned = True
+
+  def key( self ):
+    """
+    Returns a 64-bit Zobrist key of the state, cheap enough to use for
+    transposition tables and duplicate-state checks.  Equal states have
+    equal keys.
+    """
+    return self.data.key()
 
   def getAgentState(self, index):
     return self.data.agentStates[index]
@@ -134,10 +310,27 @@ class GameState:
     """
     agentState = self.data.agentStates[index]
     ret = agentState.getPosition()
-    if ret:
+    if ret and not WHOLE_STEP_MOVES:
       return tuple(int(x) for x in ret)
     return ret
 
+  def getAgentCell(self, index):
+    """
+    Returns the agent's position as a cell index, x * height + y (the order
+    of Grid's bits), or None if the agent is unobservable.  getCellPosition
+    turns it back into a location tuple.
+    """
+    pos = self.data.agentStates[index].getPosition()
+    if pos is None:
+      return None
+    return int(pos[0]) * self.data.layout.height + int(pos[1])
+
+  def getCellPosition(self, cell):
+    """
+    Returns the location tuple of a cell index from getAgentCell.
+    """
+    return divmod(cell, self.data.layout.height)
+
 
 
   def getNumAgents( self ):
@@ -154,22 +347,38 @@ class GameState:
     Returns a matrix of food that corresponds to the food on the red team's side.
     For the matrix m, m[x][y]=true if there is food in (x,y) that belongs to
     red (meaning red is protecting it, blue is trying to eat it).
+
+    The matrix is shared with the state, so treat it as read-only.
     """
-    return halfGrid(self.data.food, red = True)
+    return self.data.redFood
 
   def getBlueFood(self):
     """
     Returns a matrix of food that corresponds to the food on the blue team's side.
     For the matrix m, m[x][y]=true if there is food in (x,y) that belongs to
     blue (meaning blue is protecting it, red is trying to eat it).
+
+    The matrix is shared with the state, so treat it as read-only.
+    """
+    return self.data.blueFood
+
+  def getRedFoodCount(self):
+    """
+    Returns the number of food dots on the red team's side.
     """
-    return halfGrid(self.data.food, red = False)
+    return self.data.redFoodCount
+
+  def getBlueFoodCount(self):
+    """
+    Returns the number of food dots on the blue team's side.
+    """
+    return self.data.blueFoodCount
 
   def getRedCapsules(self):
-    return halfList(self.data.capsules, self.data.food, red = True)
+    return [c for c in self.data.capsules if c in self.data.redCapsules]
 
   def getBlueCapsules(self):
-    return halfList(self.data.capsules, self.data.food, red = False)
+    return [c for c in self.data.capsules if c in self.data.blueCapsules]
 
   def getWalls(self):
     """
@@ -197,13 +406,37 @@ class GameState:
     """
     Returns a list of agent index numbers for the agents on the red team.
     """
-    return self.redTeam[:]
+    return list(self.redTeam)
 
   def getBlueTeamIndices(self):
     """
     Returns a list of the agent index numbers for the agents on the blue team.
     """
-    return self.blueTeam[:]
+    return list(self.blueTeam)
+
+  def getRedCarrying(self):
+    """
+    Returns the number of food dots the red agents are carrying.
+    """
+    return self.data.redCarrying
+
+  def getBlueCarrying(self):
+    """
+    Returns the number of food dots the blue agents are carrying.
+    """
+    return self.data.blueCarrying
+
+  def getRedReturned(self):
+    """
+    Returns the number of food dots the red agents have brought home.
+    """
+    return self.data.redReturned
+
+  def getBlueReturned(self):
+    """
+    Returns the number of food dots the blue agents have brought home.
+    """
+    return self.data.blueReturned
 
   def isOnRedTeam(self, agentIndex):
     """
@@ -235,16 +468,29 @@ class GameState:
   # You shouldn't need to call these directly #
   #############################################
 
-  def __init__( self, prevState = None ):
+  # The game's EventBus, on the game's own states only: successors keep it,
+  # but the copies agents are given (deepCopy, makeObservation) do not
+  eventBus = None
+
+  # Where the rules draw their random numbers (the noise of makeObservation):
+  # the random module, or the game's own stream when it was given a seed
+  rulesRandom = random
+
+  def __init__( self, prevState = None, copyOnWrite = False ):
     """
     Generates a new state by copying information from its predecessor.
     """
     if prevState != None: # Initial state
-      self.data = GameStateData(prevState.data)
+      self.eventBus = prevState.eventBus
+      if prevState.rulesRandom is not random:
+        # only a game's own stream: the random module cannot be pickled
+        self.rulesRandom = prevState.rulesRandom
+      self.data = GameStateData(prevState.data, copyOnWrite)
       self.blueTeam = prevState.blueTeam
       self.redTeam = prevState.redTeam
       self.data.timeleft = prevState.data.timeleft
       self.teams = prevState.teams
+      self.opponents = prevState.opponents
       self.agentDistances = prevState.agentDistances
       self.noise = prevState.noise
     else:
@@ -254,22 +500,31 @@ class GameState:
 
   def deepCopy( self ):
     state = GameState( self )
+    state.eventBus = None
     state.data = self.data.deepCopy()
     state.data.timeleft = self.data.timeleft
-    state.blueTeam = self.blueTeam[:]
-    state.redTeam = self.redTeam[:]
-    state.teams = self.teams[:]
     state.agentDistances = self.agentDistances[:]
     state.noise = self.noise
     return state
 
   def makeObservation(self, index):
-    state = self.deepCopy()
+    # Observations share the state's data until they change it, like successors
+    state = GameState(self, copyOnWrite = True)
+    state.eventBus = None
+    data, trueData = state.data, self.data
+    data._agentMoved = trueData._agentMoved
+    data._foodEaten = trueData._foodEaten
+    data._foodAdded = trueData._foodAdded
+    data._capsuleEaten = trueData._capsuleEaten
+
     # Adds the sonar signal
-    pos = state.getAgentPosition(index)
     n = state.getNumAgents()
-    f = lambda x: manhattanDistance(pos, state.getAgentPosition(x))
-    observedDistances = [f(x) if f(x)<= SIGHT_RANGE else None for x in range(n)]
+    positions = [state.getAgentPosition(x) for x in range(n)]
+    x0, y0 = positions[index]
+    observedDistances = []
+    for x, y in positions:
+      distance = abs(x - x0) + abs(y - y0)
+      observedDistances.append(distance if distance <= SIGHT_RANGE else None)
     state.noise = [None for x in range(n)]
     state.agentDistances = observedDistances
 
@@ -283,13 +538,15 @@ class GameState:
 
     for enemy in otherTeam:
       seen = False
-      enemyPos = state.getAgentPosition(enemy)
+      x0, y0 = positions[enemy]
       for teammate in team:
-        if util.manhattanDistance(enemyPos, state.getAgentPosition(teammate)) <= SIGHT_RANGE:
+        x, y = positions[teammate]
+        if abs(x - x0) + abs(y - y0) <= SIGHT_RANGE:
           seen = True
       if not seen:
-        state.noise[enemy] = scramble(copy.deepcopy(state.data.agentStates[enemy].configuration))
-        state.data.agentStates[enemy].configuration = state.noise[enemy]
+        conf = data.agentStates[enemy].configuration
+        state.noise[enemy] = scramble(Configuration(conf.pos, conf.direction), self.rulesRandom)
+        data.getMutableAgentState(enemy).configuration = state.noise[enemy]
     return state
 
   def __eq__( self, other ):
@@ -303,7 +560,7 @@ class GameState:
     """
     Allows states to be keys of dictionaries.
     """
-    return int(hash( self.data ))
+    return hash( self.data )
 
   def __str__( self ):
 
@@ -314,15 +571,146 @@ class GameState:
     Creates an initial game state from a layout array (see layout.py).
     """
     self.data.initialize(layout, numAgents)
-    positions = [a.configuration for a in self.data.agentStates]
-    self.blueTeam = [i for i,p in enumerate(positions) if not self.isRed(p)]
-    self.redTeam = [i for i,p in enumerate(positions) if self.isRed(p)]
-    self.teams = [self.isRed(p) for p in positions]
+    self._initializeSides()
     #This is usually 60 (always 60 with random maps)
     #However, if layout map is specified otherwise, it could be less
     global TOTAL_FOOD
     TOTAL_FOOD = layout.totalFood
 
+  def _initializeSides(self):
+    """
+    Builds the per-side food grids, capsule sets and team tables from the
+    food, capsules and agents' start positions.
+    """
+    data = self.data
+    data.redFood = halfGrid(data.food, red = True)
+    data.blueFood = halfGrid(data.food, red = False)
+    data.redFoodCount = data.redFood.count()
+    data.blueFoodCount = data.blueFood.count()
+    data.redCapsules = frozenset(halfList(data.capsules, data.food, red = True))
+    data.blueCapsules = frozenset(halfList(data.capsules, data.food, red = False))
+    # Team tables are fixed for the game, so every state shares them
+    positions = [a.start for a in data.agentStates]
+    self.blueTeam = tuple([i for i,p in enumerate(positions) if not self.isRed(p)])
+    self.redTeam = tuple([i for i,p in enumerate(positions) if self.isRed(p)])
+    self.teams = tuple([self.isRed(p) for p in positions])
+    self.opponents = tuple([self.blueTeam if isRed else self.redTeam for isRed in self.teams])
+
+  def toBytes(self):
+    """
+    Returns a compact, versioned binary encoding of the state for sending
+    between processes or storing.  The layout is referenced by its digest
+    rather than included, so decoding needs the same layout (see
+    fromBytes).  The per-move display fields (_foodEaten, _foodAdded,
+    _capsuleEaten) and the sonar noise configurations are not kept.
+    """
+    data = self.data
+    layout = data.layout
+    agentStates = data.agentStates
+    flags = int(data._win) | int(data._lose) << 1 | int(bool(self.agentDistances)) << 2
+    agentMoved = data._agentMoved
+    if agentMoved is None: agentMoved = -1
+    out = [_STATE_HEADER.pack(_STATE_MAGIC, STATE_FORMAT_VERSION, layout.getDigest(),
+                              data.score, getattr(data, 'timeleft', 0), agentMoved, flags,
+                              len(agentStates))]
+    for agentState in agentStates:
+      conf = agentState.configuration
+      agentFlags = int(agentState.isPacman)
+      x, y, direction = 0, 0, Directions.STOP
+      if conf is not None:
+        agentFlags |= _AGENT_HAS_CONFIGURATION
+        x, y = conf.pos
+        direction = conf.direction
+        if x != int(x) or y != int(y):
+          agentFlags |= _AGENT_FLOAT_POSITION
+          x, y = 0, 0
+      startX, startY = agentState.start.pos
+      out.append(_AGENT_RECORD.pack(agentFlags, startX, startY, _DIRECTION_INDEX[agentState.start.direction],
+                                    int(x), int(y), _DIRECTION_INDEX[direction], agentState.scaredTimer,
+                                    agentState.numCarrying, agentState.numReturned))
+      if agentFlags & _AGENT_FLOAT_POSITION:
+        out.append(_FLOAT_POSITION.pack(*conf.pos))
+    out.append(data.food.packBytes())
+    out.append(struct.pack('>B', len(data.capsules)))
+    for capsule in data.capsules:
+      out.append(_CAPSULE.pack(*capsule))
+    if self.agentDistances:
+      out.append(struct.pack('>B', len(self.agentDistances)))
+      for distance in self.agentDistances:
+        if distance is None: distance = _NO_DISTANCE
+        out.append(_DISTANCE.pack(distance))
+    return ''.join(out)
+
+  def fromBytes(packed, layout):
+    """
+    Rebuilds a state from the output of toBytes.  layout must be the layout
+    the state was encoded with; use getPackedLayoutDigest to look it up.
+    """
+    magic, version, digest, score, timeleft, agentMoved, flags, numAgents = \
+      _STATE_HEADER.unpack_from(packed, 0)
+    if magic != _STATE_MAGIC:
+      raise ValueError('Not an encoded game state')
+    if version != STATE_FORMAT_VERSION:
+      raise ValueError('Unsupported game state format version %d' % version)
+    if digest != layout.getDigest():
+      raise ValueError('The game state was encoded with a different layout')
+    offset = _STATE_HEADER.size
+
+    state = GameState()
+    data = state.data
+    data.layout = layout
+    data.score = score
+    data.scoreChange = 0
+    data.timeleft = timeleft
+    data._win = bool(flags & 1)
+    data._lose = bool(flags & 2)
+    if agentMoved >= 0: data._agentMoved = agentMoved
+
+    data.agentStates = []
+    for i in range(numAgents):
+      agentFlags, startX, startY, startDirection, x, y, direction, scaredTimer, numCarrying, numReturned = \
+        _AGENT_RECORD.unpack_from(packed, offset)
+      offset += _AGENT_RECORD.size
+      agentState = AgentState(Configuration((startX, startY), _DIRECTIONS[startDirection]), bool(agentFlags & 1))
+      if agentFlags & _AGENT_FLOAT_POSITION:
+        x, y = _FLOAT_POSITION.unpack_from(packed, offset)
+        offset += _FLOAT_POSITION.size
+      if not agentFlags & _AGENT_HAS_CONFIGURATION:
+        agentState.configuration = None
+      elif (x, y) == agentState.start.pos and _DIRECTIONS[direction] == agentState.start.direction:
+        agentState.configuration = agentState.start
+      else:
+        agentState.configuration = Configuration((x, y), _DIRECTIONS[direction])
+      agentState.scaredTimer = scaredTimer
+      agentState.numCarrying = numCarrying
+      agentState.numReturned = numReturned
+      data.agentStates.append(agentState)
+    data._eaten = [False for a in data.agentStates]
+
+    foodSize = (layout.width * layout.height + 7) // 8
+    data.food = unpackGridBytes(layout.width, layout.height, packed[offset:offset + foodSize])
+    offset += foodSize
+    numCapsules, = struct.unpack_from('>B', packed, offset)
+    offset += 1
+    data.capsules = []
+    for i in range(numCapsules):
+      data.capsules.append(_CAPSULE.unpack_from(packed, offset))
+      offset += _CAPSULE.size
+    if flags & 4:
+      numDistances, = struct.unpack_from('>B', packed, offset)
+      offset += 1
+      for i in range(numDistances):
+        distance, = _DISTANCE.unpack_from(packed, offset)
+        offset += _DISTANCE.size
+        if distance == _NO_DISTANCE: distance = None
+        state.agentDistances.append(distance)
+
+    state._initializeSides()
+    for index, agentState in enumerate(data.agentStates):
+      state.changeCarrying(state.teams[index], agentState.numCarrying, agentState.numReturned)
+    return state
+  fromBytes = staticmethod(fromBytes)
+
   def isRed(self, configOrPos):
     width = self.data.layout.width
     if type(configOrPos) == type( (0,0) ):
@@ -330,15 +718,217 @@ class GameState:
     else:
       return configOrPos.pos[0] < width / 2
 
+  def changeCarrying(self, isRed, carrying, returned = 0):
+    """
+    Adds to the team totals of carried and returned food, which the rules
+    keep in step with the agents' numCarrying and numReturned.
+    """
+    data = self.data
+    if data._applying:
+      data._undoLog.append(('carrying', isRed, carrying, returned))
+    if isRed:
+      data.redCarrying += carrying
+      data.redReturned += returned
+    else:
+      data.blueCarrying += carrying
+      data.blueReturned += returned
+
+  def setFood(self, x, y, hasFood):
+    """
+    Adds or removes the food at (x,y), keeping the per-side food grids and
+    counts in step.  Grids are replaced rather than edited, since other
+    states may share them, except during apply, which owns them.
+    """
+    data = self.data
+    if data.food.isSet(x, y) == hasFood: return
+    change = 1 if hasFood else -1
+    if data._applying:
+      # apply owns the grids, so they are edited in place
+      self._logFood()
+    else:
+      data.food = data.food.copy()
+    data.food[x][y] = hasFood
+    if x < data.food.width / 2:
+      if not data._applying: data.redFood = data.redFood.copy()
+      data.redFood[x][y] = hasFood
+      data.redFoodCount += change
+    else:
+      if not data._applying: data.blueFood = data.blueFood.copy()
+      data.blueFood[x][y] = hasFood
+      data.blueFoodCount += change
+
+  def _logFood(self):
+    "Logs the food grids and counts for undo, before apply edits them."
+    data = self.data
+    data._undoLog.append(('food', data.food.bits, data.redFood.bits, data.blueFood.bits,
+                          data.redFoodCount, data.blueFoodCount))
+
+  def getDelta(self):
+    """
+    Returns the changes the last move made to this state, as a
+    GameStateDelta for applyDelta.
+    """
+    return GameStateDelta(self)
+
+  def applyDelta(self, delta):
+    """
+    Makes the move a GameStateDelta describes, so that a copy of the state
+    before the move becomes equal to the state after it.  Like the rules,
+    this replaces rather than edits anything other states may share, and it
+    keeps its own copies of the delta's agent states, which belong to the
+    game.
+    """
+    data = self.data
+    # replaced agents are marked owned, which apply must not take as logged
+    data._undoOwned = False
+    if data._ownedAgents is None:
+      data._ownedAgents = [True] * len(data.agentStates)
+    for index, agentState in delta.agentStates:
+      old = data.agentStates[index]
+      self.changeCarrying(self.teams[index], agentState.numCarrying - old.numCarrying,
+                          agentState.numReturned - old.numReturned)
+      data.agentStates[index] = agentState.copy()
+      data._ownedAgents[index] = True
+    if delta.foodEaten is not None:
+      self.setFood(delta.foodEaten[0], delta.foodEaten[1], False)
+    if delta.foodAdded:
+      self.addFood(delta.foodAdded)
+    if delta.capsuleEaten is not None:
+      data._ownsCapsules = False
+      self.removeCapsule(delta.capsuleEaten)
+    data._agentMoved = delta.agentMoved
+    data._foodEaten = delta.foodEaten
+    data._foodAdded = delta.foodAdded
+    data._capsuleEaten = delta.capsuleEaten
+    data.scoreChange = delta.scoreChange
+    data.score += delta.scoreChange
+    data.timeleft = delta.timeleft
+    data._win = delta.win
+    data._key = None
+
+  def removeCapsule(self, position):
+    """
+    Removes the capsule at position.  The per-side capsule sets are shared
+    between states, so the changed side is replaced rather than edited.
+    """
+    data = self.data
+    capsules = data.getMutableCapsules()
+    index = capsules.index(position)
+    if data._applying:
+      data._undoLog.append(('capsule', position, index, data.redCapsules, data.blueCapsules))
+    del capsules[index]
+    if position in data.redCapsules:
+      data.redCapsules = data.redCapsules.difference([position])
+    else:
+      data.blueCapsules = data.blueCapsules.difference([position])
+
+  def addFood(self, positions):
+    """
+    Puts food on each empty (x,y) in positions, like setFood but copying
+    each grid only once.
+    """
+    data = self.data
+    height = data.food.height
+    added = 0
+    for x, y in positions:
+      added |= 1 << (x * height + y)
+    added &= ~data.food.bits
+    if not added: return
+    # columns are contiguous in the bitboard, so a side is a single mask
+    redAdded = added & ((1 << (data.food.width / 2 * height)) - 1)
+    blueAdded = added & ~redAdded
+    inPlace = data._applying
+    if inPlace: self._logFood()
+    else: data.food = data.food.copy()
+    data.food.bits |= added
+    if redAdded:
+      if not inPlace: data.redFood = data.redFood.copy()
+      data.redFood.bits |= redAdded
+      data.redFoodCount += bin(redAdded).count('1')
+    if blueAdded:
+      if not inPlace: data.blueFood = data.blueFood.copy()
+      data.blueFood.bits |= blueAdded
+      data.blueFoodCount += bin(blueAdded).count('1')
+
+class GameStateDelta:
+  """
+  The changes one move made to a capture GameState: the agent that moved,
+  the new states of the agents the move changed (the mover, and any agent
+  that was killed or scared), the food eaten and added, the capsule eaten,
+  the score change, the time left and whether the game is won.  The agent
+  states are shared with the game, so treat them as read-only;
+  GameState.applyDelta stores copies of them.
+  """
+
+  def __init__(self, state):
+    data = state.data
+    owned = data._ownedAgents
+    self.agentMoved = data._agentMoved
+    self.agentStates = [(i, agentState) for i, agentState in enumerate(data.agentStates)
+                        if owned is None or owned[i]]
+    self.foodEaten = data._foodEaten
+    self.foodAdded = data._foodAdded
+    self.capsuleEaten = data._capsuleEaten
+    self.scoreChange = data.scoreChange
+    self.timeleft = data.timeleft
+    self.win = data._win
+
+# Binary state encoding (see GameState.toBytes)
+STATE_FORMAT_VERSION = 1
+_STATE_MAGIC = 'CS'
+_STATE_HEADER = struct.Struct('>2sB20siihBB')
+_AGENT_RECORD = struct.Struct('>BhhBhhBHHH')
+_FLOAT_POSITION = struct.Struct('>dd')
+_CAPSULE = struct.Struct('>hh')
+_DISTANCE = struct.Struct('>h')
+_NO_DISTANCE = -32768
+_AGENT_HAS_CONFIGURATION = 2
+_AGENT_FLOAT_POSITION = 4
+_DIRECTIONS = [Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST, Directions.STOP]
+_DIRECTION_INDEX = dict([(d, i) for i, d in enumerate(_DIRECTIONS)])
+
+def getPackedLayoutDigest(packed):
+  """
+  Returns the digest of the layout a GameState.toBytes encoding refers to,
+  to match against Layout.getDigest.
+  """
+  return _STATE_HEADER.unpack_from(packed, 0)[2]
+
+def measureStateEncoding(states, repeats = 5):
+  """
+  Times GameState.toBytes and fromBytes over states (all on one layout),
+  next to cPickle at its highest protocol.  Returns {'bytes': ...,
+  'cPickle': ...}, each holding the states encoded and decoded per second
+  and the mean encoded size in bytes.
+  """
+  import cPickle
+  layout = states[0].data.layout
+  codecs = [('bytes', lambda s: s.toBytes(), lambda b: GameState.fromBytes(b, layout)),
+            ('cPickle', lambda s: cPickle.dumps(s, cPickle.HIGHEST_PROTOCOL), cPickle.loads)]
+  results = {}
+  for name, encode, decode in codecs:
+    start = time.time()
+    for i in range(repeats):
+      encoded = [encode(s) for s in states]
+    encodeTime = time.time() - start
+    start = time.time()
+    for i in range(repeats):
+      for b in encoded:
+        decode(b)
+    decodeTime = time.time() - start
+    count = float(repeats * len(states))
+    results[name] = {'encode': count / max(encodeTime, 1e-9),
+                     'decode': count / max(decodeTime, 1e-9),
+                     'size': sum([len(b) for b in encoded]) / float(len(encoded))}
+  return results
+
 def halfGrid(grid, red):
   halfway = grid.width / 2
   halfgrid = Grid(grid.width, grid.height, False)
-  if red:    xrange = range(halfway)
-  else:       xrange = range(halfway, grid.width)
-
-  for y in range(grid.height):
-    for x in xrange:
-      if grid[x][y]: halfgrid[x][y] = True
+  # columns are contiguous in the bitboard, so a side is a single mask
+  redMask = (1 << (halfway * grid.height)) - 1
+  if red:    halfgrid.bits = grid.bits & redMask
+  else:       halfgrid.bits = grid.bits & ~redMask
 
   return halfgrid
 
@@ -364,22 +954,40 @@ class CaptureRules:
   and how the game starts and ends.
   """
 
-  def __init__(self, quiet = False):
+  def __init__(self, quiet = False, eventBus = None):
+    """
+    With an eventBus (a game.EventBus), the games' moves, captures and
+    endings are published to it as the events defined at the top of this
+    file.
+    """
     self.quiet = quiet
+    self.eventBus = eventBus
 
-  def newGame( self, layout, agents, display, length, muteAgents, catchExceptions, startingTeam):
+  def newGame( self, layout, agents, display, length, muteAgents, catchExceptions, startingTeam, timePhases=False, outputLimit=None, outputLog=None, seed=None):
+    """
+    With a seed, the game gets its own random streams, derived from it
+    with util.randomStream: one for the rules (GameState.rulesRandom) and
+    one for each agent, set as agent.random.
+    """
+    layout.freeze() # every copy of the state shares this layout
     initState = GameState()
     initState.initialize( layout, len(agents) )
+    initState.eventBus = self.eventBus
+    if seed is not None:
+      initState.rulesRandom = util.randomStream(seed, 'rules')
+      for i, agent in enumerate(agents):
+        if agent: agent.random = util.randomStream(seed, 'agent', i)
     starter = startingTeam
-    print('%s team starts' % ['Red', 'Blue'][starter])
-    game = Game(agents, display, self, startingIndex=starter, muteAgents=muteAgents, catchExceptions=catchExceptions)
+    if not self.quiet: print('%s team starts' % ['Red', 'Blue'][starter])
+    game = Game(agents, display, self, startingIndex=starter, muteAgents=muteAgents, catchExceptions=catchExceptions, timePhases=timePhases,
+                outputLimit=outputLimit, outputLog=outputLog)
     game.state = initState
     game.length = length
     game.state.data.timeleft = length
     if 'drawCenterLine' in dir(display):
       display.drawCenterLine()
-    self._initBlueFood = initState.getBlueFood().count()
-    self._initRedFood = initState.getRedFood().count()
+    self._initBlueFood = initState.getBlueFoodCount()
+    self._initRedFood = initState.getRedFoodCount()
     return game
 
   def process(self, state, game):
@@ -392,17 +1000,15 @@ class CaptureRules:
 
     if state.isOver():
       game.gameOver = True
+      redCount = state.getRedReturned()
+      blueCount = state.getBlueReturned()
+      foodToWin = (TOTAL_FOOD/2) - MIN_FOOD
+      if state.eventBus is not None:
+        if blueCount >= foodToWin: reason = 'blue returned food'
+        elif redCount >= foodToWin: reason = 'red returned food'
+        else: reason = 'time'
+        state.eventBus.publish(GameEndEvent(state.data.score, reason))
       if not game.rules.quiet:
-        redCount = 0
-        blueCount = 0
-        foodToWin = (TOTAL_FOOD/2) - MIN_FOOD
-        for index in range(state.getNumAgents()):
-          agentState = state.data.agentStates[index]
-          if index in state.getRedTeamIndices():
-            redCount += agentState.numReturned
-          else:
-            blueCount += agentState.numReturned
-
         if blueCount >= foodToWin:#state.getRedFood().count() == MIN_FOOD:
           print 'The Blue team has returned at least %d of the opponents\' dots.' % foodToWin
         elif redCount >= foodToWin:#state.getBlueFood().count() == MIN_FOOD:
@@ -416,8 +1022,8 @@ class CaptureRules:
             print 'The %s team wins by %d points.' % (winner, abs(state.data.score))
 
   def getProgress(self, game):
-    blue = 1.0 - (game.state.getBlueFood().count() / float(self._initBlueFood))
-    red = 1.0 - (game.state.getRedFood().count() / float(self._initRedFood))
+    blue = 1.0 - (game.state.getBlueFoodCount() / float(self._initBlueFood))
+    red = 1.0 - (game.state.getRedFoodCount() / float(self._initRedFood))
     moves = len(self.moveHistory) / float(game.length)
 
     # return the most likely progress indicator, clamped to [0, 1]
@@ -430,6 +1036,8 @@ class CaptureRules:
     else:
       print >>sys.stderr, "Blue agent crashed"
       game.state.data.score = 1
+    if game.state.eventBus is not None:
+      game.state.eventBus.publish(GameEndEvent(game.state.data.score, 'crash'))
 
   def getMaxTotalTime(self, agentIndex):
     return 900  # Move limits should prevent this from ever happening
@@ -446,6 +1054,32 @@ class CaptureRules:
   def getMaxTimeWarnings(self, agentIndex):
     return 2  # Third violation loses the game
 
+_foodDumpOffsets = []
+
+def foodDumpOffsets(radius):
+  """
+  Iterates over the (dx, dy) offsets within the given chessboard distance, in the
+  order dumpFoodFromDeath has always searched them: a breadth-first search
+  over all eight neighbours (and the cell itself) that ignores walls, so the
+  order is the same around every cell.  The order is computed once and
+  extended when a larger radius is asked for.
+  """
+  size = (2 * radius + 1) ** 2
+  if len(_foodDumpOffsets) < size:
+    offsets = []
+    seen = set()
+    queue = collections.deque([(0, 0)])
+    while len(offsets) < size:
+      popped = queue.popleft()
+      if popped in seen:
+        continue
+      seen.add(popped)
+      offsets.append(popped)
+      x, y = popped
+      queue.extend([(x + dx, y + dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+    _foodDumpOffsets[:] = offsets
+  return itertools.islice(_foodDumpOffsets, size)
+
 class AgentRules:
   """
   These functions govern how each agent interacts with her environment.
@@ -466,16 +1100,18 @@ class AgentRules:
   filterForAllowedActions = staticmethod( filterForAllowedActions )
 
 
-  def applyAction( state, action, agentIndex ):
+  def applyAction( state, action, agentIndex, legal = None ):
     """
-    Edits the state to reflect the results of the action.
+    Edits the state to reflect the results of the action.  Callers that
+    already know the legal actions can pass them in as legal.
     """
-    legal = AgentRules.getLegalActions( state, agentIndex )
+    if legal is None:
+      legal = AgentRules.getLegalActions( state, agentIndex )
     if action not in legal:
       raise Exception("Illegal action " + str(action))
 
     # Update Configuration
-    agentState = state.data.agentStates[agentIndex]
+    agentState = state.data.getMutableAgentState(agentIndex)
     speed = 1.0
     # if agentState.isPacman: speed = 0.5
     vector = Actions.directionToVector( action, speed )
@@ -484,7 +1120,12 @@ class AgentRules:
 
     # Eat
     next = agentState.configuration.getPosition()
-    nearest = nearestPoint( next )
+    if state.eventBus is not None:
+      state.eventBus.publish(MoveEvent(agentIndex, action, next))
+    if WHOLE_STEP_MOVES:
+      nearest = next
+    else:
+      nearest = nearestPoint( next )
 
     if next == nearest:
       isRed = state.isOnRedTeam(agentIndex)
@@ -496,73 +1137,76 @@ class AgentRules:
         score = agentState.numCarrying if isRed else -1*agentState.numCarrying
         state.data.scoreChange += score
 
+        state.changeCarrying(isRed, -agentState.numCarrying, agentState.numCarrying)
+        if state.eventBus is not None:
+          state.eventBus.publish(FoodReturnedEvent(agentIndex, agentState.numCarrying, score))
         agentState.numReturned += agentState.numCarrying
         agentState.numCarrying = 0
 
-        redCount = 0
-        blueCount = 0
-        for index in range(state.getNumAgents()):
-          agentState = state.data.agentStates[index]
-          if index in state.getRedTeamIndices():
-            redCount += agentState.numReturned
-          else:
-            blueCount += agentState.numReturned
-        if redCount >= (TOTAL_FOOD/2) - MIN_FOOD or blueCount >= (TOTAL_FOOD/2) - MIN_FOOD:
+        foodToWin = (TOTAL_FOOD/2) - MIN_FOOD
+        if state.data.redReturned >= foodToWin or state.data.blueReturned >= foodToWin:
           state.data._win = True
 
 
-    if agentState.isPacman and manhattanDistance( nearest, next ) <= 0.9 :
-      AgentRules.consume( nearest, state, state.isOnRedTeam(agentIndex) )
+    if agentState.isPacman and (WHOLE_STEP_MOVES or manhattanDistance( nearest, next ) <= 0.9):
+      AgentRules.consume( nearest, state, state.isOnRedTeam(agentIndex), agentIndex )
 
   applyAction = staticmethod( applyAction )
 
-  def consume( position, state, isRed ):
+  def consume( position, state, isRed, agentIndex = None ):
     x,y = position
     # Eat food
-    if state.data.food[x][y]:
+    if state.data.food.isSet(x, y):
 
       # blue case is the default
-      teamIndicesFunc = state.getBlueTeamIndices
+      team = state.blueTeam
       score = -1
       if isRed:
         # switch if its red
         score = 1
-        teamIndicesFunc = state.getRedTeamIndices
+        team = state.redTeam
 
       # go increase the variable for the pacman who ate this
-      agents = [state.data.agentStates[agentIndex] for agentIndex in teamIndicesFunc()]
-      for agent in agents:
-        if agent.getPosition() == position:
-          agent.numCarrying += 1
+      eater = None
+      for index in team:
+        if state.data.agentStates[index].getPosition() == position:
+          state.data.getMutableAgentState(index).numCarrying += 1
+          state.changeCarrying(isRed, 1)
+          eater = index
           break # the above should only be true for one agent...
+      if state.eventBus is not None:
+        state.eventBus.publish(FoodEatenEvent(eater, position))
 
       # do all the score and food grid maintainenace
       #state.data.scoreChange += score
-      state.data.food = state.data.food.copy()
-      state.data.food[x][y] = False
+      state.setFood(x, y, False)
       state.data._foodEaten = position
       #if (isRed and state.getBlueFood().count() == MIN_FOOD) or (not isRed and state.getRedFood().count() == MIN_FOOD):
       #  state.data._win = True
 
     # Eat capsule
-    if isRed: myCapsules = state.getBlueCapsules()
-    else: myCapsules = state.getRedCapsules()
+    if isRed: myCapsules = state.data.blueCapsules
+    else: myCapsules = state.data.redCapsules
     if( position in myCapsules ):
-      state.data.capsules.remove( position )
+      state.removeCapsule( position )
       state.data._capsuleEaten = position
+      if state.eventBus is not None:
+        state.eventBus.publish(CapsuleEatenEvent(agentIndex, position))
 
       # Reset all ghosts' scared timers
-      if isRed: otherTeam = state.getBlueTeamIndices()
-      else: otherTeam = state.getRedTeamIndices()
+      if isRed: otherTeam = state.blueTeam
+      else: otherTeam = state.redTeam
       for index in otherTeam:
-        state.data.agentStates[index].scaredTimer = SCARED_TIME
+        state.data.getMutableAgentState(index).scaredTimer = SCARED_TIME
 
   consume = staticmethod( consume )
 
   def decrementTimer(state):
     timer = state.scaredTimer
-    if timer == 1:
-      state.configuration.pos = nearestPoint( state.configuration.pos )
+    if timer == 1 and not WHOLE_STEP_MOVES:
+      # configurations can be shared between states, so replace rather than edit
+      conf = state.configuration
+      state.configuration = Configuration( nearestPoint( conf.pos ), conf.direction )
     state.scaredTimer = max( 0, timer - 1 )
   decrementTimer = staticmethod( decrementTimer )
 
@@ -590,89 +1234,62 @@ class AgentRules:
     scoreDirection = (-1)**(int(isRed) + 1)
     #state.data.scoreChange += scoreDirection * agentState.numCarrying
 
-    def onRightSide(state, x, y):
-      dummyConfig = Configuration((x, y), 'North')
-      return state.isRed(dummyConfig) == isRed
-
     # we have food to dump
-    # -- expand out in BFS. Check:
+    # -- visit cells in BFS order around the agent. Check:
     #   - that it's within the limits
     #   - that it's not a wall
     #   - that no other agents are there
     #   - that no power pellets are there
     #   - that it's on the right side of the grid
-    def allGood(state, x, y):
-      width, height = state.data.layout.width, state.data.layout.height
-      food, walls = state.data.food, state.data.layout.walls
-
-      # bounds check
-      if x >= width or y >= height or x <= 0 or y <= 0:
-        return False
-
-      if walls[x][y]:
-        return False
-      if food[x][y]:
-        return False
-
-      # dots need to be on the side where this agent will be a pacman :P
-      if not onRightSide(state, x, y):
-        return False
-
-      if (x,y) in state.data.capsules:
-        return False
-
-      # loop through agents
-      agentPoses = [state.getAgentPosition(i) for i in range(state.getNumAgents())]
-      if (x,y) in agentPoses:
-        return False
-
-      return True
+    layout = state.data.layout
+    width, height = layout.width, layout.height
+    walls = layout.walls
+    halfway = width / 2
+    redCapsules, blueCapsules = state.data.redCapsules, state.data.blueCapsules
+    agentPoses = set([state.getAgentPosition(i) for i in range(state.getNumAgents())])
 
     numToDump = agentState.numCarrying
-    state.data.food = state.data.food.copy()
     foodAdded = []
 
-    def genSuccessors(x, y):
-      DX = [-1, 0, 1]
-      DY = [-1, 0, 1]
-      return [(x + dx, y + dy) for dx in DX for dy in DY]
+    x0, y0 = [int(i) for i in agentState.getPosition()]
+    # cells past this distance are all outside the grid
+    radius = max(x0, width - x0, y0, height - y0)
+    for dx, dy in foodDumpOffsets(radius):
+      x, y = x0 + dx, y0 + dy
 
-    # BFS graph search
-    positionQueue = [agentState.getPosition()]
-    seen = set()
-    while numToDump > 0:
-      if not len(positionQueue):
-        raise Exception('Exhausted BFS! uh oh')
-      # pop one off, graph check
-      popped = positionQueue.pop(0)
-      if popped in seen:
+      # bounds check
+      if x >= width or y >= height or x <= 0 or y <= 0:
+        continue
+      if walls.isSet(x, y) or state.data.food.isSet(x, y):
+        continue
+      # dots need to be on the side where this agent will be a pacman :P
+      if (x < halfway) != isRed:
+        continue
+      if (x, y) in redCapsules or (x, y) in blueCapsules or (x, y) in agentPoses:
         continue
-      seen.add(popped)
-
-      x, y = popped[0], popped[1]
-      x = int(x)
-      y = int(y)
-      if (allGood(state, x, y)):
-        state.data.food[x][y] = True
-        foodAdded.append((x, y))
-        numToDump -= 1
 
-      # generate successors
-      positionQueue = positionQueue + genSuccessors(x, y)
+      # each cell is visited once, so the food can be placed after the search
+      foodAdded.append((x, y))
+      numToDump -= 1
+      if numToDump == 0:
+        break
+    else:
+      raise Exception('Exhausted BFS! uh oh')
 
+    state.addFood(foodAdded)
     state.data._foodAdded = foodAdded
-    # now our agentState is no longer carrying food
+    if state.eventBus is not None:
+      state.eventBus.publish(FoodDumpEvent(agentIndex, foodAdded))
+    # now our agentState is no longer carrying food; it died on the other
+    # team's side, so its own team is the opposite of isRed
+    state.changeCarrying(not isRed, -agentState.numCarrying)
     agentState.numCarrying = 0
     pass
-
   dumpFoodFromDeath = staticmethod(dumpFoodFromDeath)
 
   def checkDeath( state, agentIndex):
     agentState = state.data.agentStates[agentIndex]
-    if state.isOnRedTeam(agentIndex):
-      otherTeam = state.getBlueTeamIndices()
-    else:
-      otherTeam = state.getRedTeamIndices()
+    otherTeam = state.opponents[agentIndex]
     if agentState.isPacman:
       for index in otherTeam:
         otherAgentState = state.data.agentStates[index]
@@ -682,6 +1299,9 @@ class AgentRules:
         if manhattanDistance( ghostPosition, agentState.getPosition() ) <= COLLISION_TOLERANCE:
           # award points to the other team for killing Pacmen
           if otherAgentState.scaredTimer <= 0:
+            if state.eventBus is not None:
+              state.eventBus.publish(DeathEvent(agentIndex, agentState.getPosition(), index))
+            agentState = state.data.getMutableAgentState(agentIndex)
             AgentRules.dumpFoodFromDeath(state, agentState, agentIndex)
 
             score = KILL_POINTS
@@ -696,6 +1316,9 @@ class AgentRules:
             if state.isOnRedTeam(agentIndex):
               score = -score
             state.data.scoreChange += score
+            if state.eventBus is not None:
+              state.eventBus.publish(DeathEvent(index, ghostPosition, agentIndex))
+            otherAgentState = state.data.getMutableAgentState(index)
             otherAgentState.isPacman = False
             otherAgentState.configuration = otherAgentState.start
             otherAgentState.scaredTimer = 0
@@ -708,7 +1331,10 @@ class AgentRules:
         if manhattanDistance( pacPos, agentState.getPosition() ) <= COLLISION_TOLERANCE:
           #award points to the other team for killing Pacmen
           if agentState.scaredTimer <= 0:
-            AgentRules.dumpFoodFromDeath(state, otherAgentState, agentIndex)
+            if state.eventBus is not None:
+              state.eventBus.publish(DeathEvent(index, pacPos, agentIndex))
+            otherAgentState = state.data.getMutableAgentState(index)
+            AgentRules.dumpFoodFromDeath(state, otherAgentState, index)
 
             score = KILL_POINTS
             if not state.isOnRedTeam(agentIndex):
@@ -722,6 +1348,9 @@ class AgentRules:
             if state.isOnRedTeam(agentIndex):
               score = -score
             state.data.scoreChange += score
+            if state.eventBus is not None:
+              state.eventBus.publish(DeathEvent(agentIndex, agentState.getPosition(), index))
+            agentState = state.data.getMutableAgentState(agentIndex)
             agentState.isPacman = False
             agentState.configuration = agentState.start
             agentState.scaredTimer = 0
@@ -809,7 +1438,17 @@ def readCommand( argv ):
   parser.add_option('-c', '--catchExceptions', action='store_true', default=True,
                     help='Catch exceptions and enforce time limits')
   parser.add_option('-s', '--seed', dest='seed', type='int',
-                    help='Seed to initialize python random, if no seed is provided, the specified or default layout will be used.')
+                    help='Seed to initialize python random, if no seed is provided, the specified or default layout will be used. '
+                    'Each maze and game also gets its own random streams derived from it.')
+  parser.add_option('--asyncDisplay', action='store_true', default=False,
+                    help='Draw the graphics on their own thread, dropping frames when they fall behind (no keyboard agents)')
+  parser.add_option('--timePhases', action='store_true', default=False,
+                    help='Time each phase of every move and report percentiles')
+  parser.add_option('--outputLimit', type='int', default=None, metavar='BYTES',
+                    help='Keep at most BYTES of each muted agent\'s output in memory; 0 discards it. '
+                         'Defaults to 64KB with --outputLog, otherwise no limit')
+  parser.add_option('--outputLog', default=None, metavar='DIR',
+                    help='Write the output of muted agents to DIR, gzipped, one file per agent and game')
 
   options, otherjunk = parser.parse_args(argv)
   assert len(otherjunk) == 0, "Unrecognized options: " + str(otherjunk)
@@ -834,6 +1473,11 @@ def readCommand( argv ):
     # Hack for agents writing to the display
     captureGraphicsDisplay.FRAME_TIME = 0
     args['display'] = captureGraphicsDisplay.PacmanGraphics(options.red, options.blue, options.zoom, 0, capture=True)
+    if options.asyncDisplay:
+      if options.keys0 or options.keys1 or options.keys2 or options.keys3:
+        raise Exception('Keyboard agents need the graphics on the main thread; drop --asyncDisplay')
+      import threadedDisplay
+      args['display'] = threadedDisplay.ThreadedDisplay(args['display'])
     import __main__
     __main__.__dict__['_display'] = args['display']
 
@@ -889,7 +1533,11 @@ def readCommand( argv ):
           if l == None: raise Exception("The layout " + options.layout + " cannot be found")
     else:
         print("Called random layout")
-        l = layout.Layout(randomLayout(random.randint(0,99999999)).split('\n'))
+        if options.seed is None:
+          mazeSeed = random.randint(0,99999999)
+        else:
+          mazeSeed = util.randomStream(options.seed, 'maze', i).randint(0,99999999)
+        l = layout.Layout(randomLayout(mazeSeed).split('\n'))
 
 
     layouts.append(l)
@@ -900,6 +1548,10 @@ def readCommand( argv ):
   args['numTraining'] = options.numTraining
   args['record'] = options.record
   args['catchExceptions'] = options.catchExceptions
+  args['timePhases'] = options.timePhases
+  args['outputLimit'] = options.outputLimit
+  args['outputLog'] = options.outputLog
+  args['seed'] = options.seed
   return args
 
 def randomLayout(seed):
@@ -962,10 +1614,13 @@ def replayGame( layout, agents, actions, display, length, redTeamName, blueTeamN
 
     display.finish()
 
-def runGames( layouts, agents, display, length, numMatches, record, numTraining, redTeamName, blueTeamName, muteAgents=False, catchExceptions=False ):
+def runGames( layouts, agents, display, length, numMatches, record, numTraining, redTeamName, blueTeamName, muteAgents=False, catchExceptions=False, timePhases=False, outputLimit=None, outputLog=None, seed=None ):
 
   rules = CaptureRules()
   matches = []
+  phaseTimes = None
+  if timePhases:
+    phaseTimes = PhaseTimes(len(agents))
 
   if numTraining > 0:
     print 'Playing %d training games' % numTraining
@@ -985,9 +1640,19 @@ def runGames( layouts, agents, display, length, numMatches, record, numTraining,
         else:
             gameDisplay = display
             rules.quiet = False
-        g = rules.newGame( layout, agents, gameDisplay, length, muteAgents, catchExceptions, startingTeam)
+        gameLog = None
+        if outputLog:
+          if not os.path.exists(outputLog):
+            os.makedirs(outputLog)
+          gameLog = os.path.join(outputLog, redTeamName+'-'+blueTeamName+'-'+str(i)+'-'+str(startingTeam))
+        # Each game's streams depend only on the seed and which game it is
+        gameSeed = None
+        if seed is not None: gameSeed = util.deriveSeed(seed, 'game', i, startingTeam)
+        g = rules.newGame( layout, agents, gameDisplay, length, muteAgents, catchExceptions, startingTeam, timePhases,
+                           outputLimit, gameLog, gameSeed)
         g.run()
         if not beQuiet: rounds.append(g)
+        if timePhases: phaseTimes.add(g.phaseTimes)
 
         g.record = None
         if record:
@@ -1058,6 +1723,8 @@ def runGames( layouts, agents, display, length, numMatches, record, numTraining,
     'matches':matchResults,
     'roundScores':scores
   }
+  if timePhases:
+    results['phaseTimes'] = phaseTimes.getSummary()
   print 'Winner: '+winner
   print 'Red Matches: '+str(redMatches)
   print 'Blue Matches: '+str(blueMatches)
@@ -1065,6 +1732,11 @@ def runGames( layouts, agents, display, length, numMatches, record, numTraining,
   print 'Blue Rounds: '+str(blueRounds)
   print 'Matches: '+str(matchResults)
   print 'Round Scores: '+str(scores)
+  if timePhases:
+    print 'Phase times in ms (p50 / p95 / p99 / max):'
+    for phase in PhaseTimes.PHASES:
+      stats = results['phaseTimes'][phase]['all']
+      print '  %-17s %8.3f %8.3f %8.3f %8.3f' % (phase, 1000*stats['p50'], 1000*stats['p95'], 1000*stats['p99'], 1000*stats['max'])
   return results
 
 def save_score(game):
@@ -20,6 +20,7 @@ from game import Agent
 import distanceCalculator
 from util import nearestPoint
 import util
+import random
 
 # Note: the following class is not used, but is kept for backwards
 # compatibility with team submissions that try to import it.
@@ -39,9 +40,10 @@ class RandomAgent( Agent ):
   """
   def __init__( self, index ):
     self.index = index
+    self.random = random
 
   def getAction( self, state ):
-    return random.choice( state.getLegalActions( self.index ) )
+    return self.random.choice( state.getLegalActions( self.index ) )
 
 class CaptureAgent(Agent):
   """
@@ -51,6 +53,10 @@ class CaptureAgent(Agent):
   Recommended Usage:  Subclass CaptureAgent and override chooseAction.
   """
 
+  # Set to True to be sent the changes each move made (see observeDeltas)
+  # instead of a full copy of the game state every turn
+  useDeltaObservations = False
+
   #############################
   # Methods to store key info #
   #############################
@@ -88,6 +94,10 @@ class CaptureAgent(Agent):
     # Access to the graphics
     self.display = None
 
+    # Random choices: the random module, or this agent's own stream when
+    # the game was given a seed (see CaptureRules.newGame)
+    self.random = random
+
   def registerInitialState(self, gameState):
     """
     This method handles the initial setup of the
@@ -99,6 +109,8 @@ class CaptureAgent(Agent):
     self.distancer.getDistance(p1, p2)
     """
     self.red = gameState.isOnRedTeam(self.index)
+    if self.useDeltaObservations:
+      self.stateMirror = gameState.deepCopy()
     self.distancer = distanceCalculator.Distancer(gameState.data.layout)
 
     # comment this out to forgo maze distance computation and use manhattan distances
@@ -122,20 +134,36 @@ class CaptureAgent(Agent):
     " Changing this won't affect pacclient.py, but will affect capture.py "
     return gameState.makeObservation(self.index)
 
+  def observeDeltas(self, deltas):
+    """
+    Used instead of observationFunction when useDeltaObservations is set.
+    Applies the moves made since this agent's last turn to its own copy of
+    the game state, self.stateMirror, and returns the observation of it.
+    """
+    for delta in deltas:
+      self.stateMirror.applyDelta(delta)
+    return self.observationFunction(self.stateMirror)
+
   def debugDraw(self, cells, color, clear=False):
 
-    if self.display:
-      from captureGraphicsDisplay import PacmanGraphics
-      if isinstance(self.display, PacmanGraphics):
-        if not type(cells) is list:
-          cells = [cells]
-        self.display.debugDraw(cells, color, clear)
+    if self._drawsDebug():
+      if not type(cells) is list:
+        cells = [cells]
+      self.display.debugDraw(cells, color, clear)
 
   def debugClear(self):
-    if self.display:
-      from captureGraphicsDisplay import PacmanGraphics
-      if isinstance(self.display, PacmanGraphics):
-        self.display.clearDebug()
+    if self._drawsDebug():
+      self.display.clearDebug()
+
+  def _drawsDebug(self):
+    "Whether the display is a capture graphics display, possibly on its own thread."
+    if not self.display: return False
+    from captureGraphicsDisplay import PacmanGraphics
+    from threadedDisplay import ThreadedDisplay
+    display = self.display
+    if isinstance(display, ThreadedDisplay):
+      display = display.display
+    return isinstance(display, PacmanGraphics)
 
   #################
   # Action Choice #
@@ -272,8 +300,9 @@ class TimeoutAgent( Agent ):
   """
   def __init__( self, index ):
     self.index = index
+    self.random = random
 
   def getAction( self, state ):
-    import random, time
+    import time
     time.sleep(2.0)
-    return random.choice( state.getLegalActions( self.index ) )
+    return self.random.choice( state.getLegalActions( self.index ) )
@@ -0,0 +1,187 @@
+# captureEnv.py
+# -------------
+# Licensing Information:  You are free to use or extend these projects for
+# educational purposes provided that (1) you do not distribute or publish
+# solutions, (2) you retain this notice, and (3) you provide clear
+# attribution to UC Berkeley, including a link to http://ai.berkeley.edu.
+#
+# Attribution Information: The Pacman AI projects were developed at UC Berkeley.
+# The core projects and autograders were primarily created by John DeNero
+# (denero@cs.berkeley.edu) and Dan Klein (klein@cs.berkeley.edu).
+# Student side autograding was added by Brad Miller, Nick Hay, and
+# Pieter Abbeel (pabbeel@cs.berkeley.edu).
+
+
+"""
+A reset/step environment over the capture rules, for learning agents that
+drive the game directly instead of being called back by Game.run.
+
+  env = CaptureEnv()
+  observations = env.reset('defaultCapture', seed = 1)
+  while True:
+    actions = [policy(observations[i]) for i in range(env.numAgents)]
+    observations, rewards, done, info = env.step(actions)
+    if done: break
+
+Each agent's observation is a flat array of NUM_PLANES planes of
+width * height values.  Cell (x,y) of plane p is at index
+p * width * height + x * height + y, the Grid bitboard order.
+"""
+
+from capture import CaptureRules
+from capture import randomLayout
+from util import manhattanDistance
+from game import Directions
+import capture
+import game
+import layout
+import textDisplay
+import util
+import array, random
+
+# Observation planes
+WALL_PLANE = 0
+OWN_FOOD_PLANE = 1      # food the agent's team defends
+ENEMY_FOOD_PLANE = 2    # food the agent's team can eat
+CAPSULE_PLANE = 3
+SELF_PLANE = 4
+TEAMMATE_PLANE = 5
+OPPONENT_PLANE = 6      # opponents the agent's team can see
+SCARED_PLANE = 7        # scared timers of the agents in the planes above
+NUM_PLANES = 8
+
+class CaptureEnv:
+  """
+  Plays one capture game at a time through CaptureRules.newGame and
+  GameState.generateSuccessor.  The observation arrays are allocated when
+  the board size changes and refilled in place after every reset and step,
+  so keep a copy of any observation that has to outlive the next step.
+  """
+
+  def __init__(self, length = capture.MAX_MOVES, numAgents = 4, startingTeam = 0):
+    self.length = length
+    self.numAgents = numAgents
+    self.startingTeam = startingTeam
+    self.rules = CaptureRules(quiet = True)
+    self.agents = [game.Agent(i) for i in range(numAgents)]
+    self.display = textDisplay.NullGraphics()
+    self.observations = []
+    self.game = None
+    self.state = None
+
+  def reset(self, gameLayout = None, seed = None):
+    """
+    Starts a new game and returns the observations.  gameLayout is a
+    layout.Layout or the name of one; without it a random maze is
+    generated, as capture.py does.  A seed picks the random maze and seeds
+    the game's random streams (see CaptureRules.newGame), leaving python
+    random alone.
+    """
+    if gameLayout is None:
+      if seed is None:
+        mazeSeed = random.randint(0,99999999)
+      else:
+        mazeSeed = util.randomStream(seed, 'maze').randint(0,99999999)
+      gameLayout = layout.Layout(randomLayout(mazeSeed).split('\n'))
+    elif isinstance(gameLayout, str):
+      name = gameLayout
+      gameLayout = layout.getLayout(name)
+      if gameLayout == None: raise Exception("The layout " + name + " cannot be found")
+    self.game = self.rules.newGame(gameLayout, self.agents, self.display, self.length,
+                                   False, False, self.startingTeam, seed = seed)
+    self.state = self.game.state
+    self.agentIndex = self.game.startingIndex
+    self._allocate(gameLayout)
+    self._observe()
+    return self.observations
+
+  def step(self, actions):
+    """
+    Plays one round: starting with the agent whose turn it is, each agent
+    in turn takes actions[agentIndex], until every agent has moved or the
+    game ends.  Returns (observations, rewards, done, info), where rewards
+    holds each agent's change in score from its team's point of view.
+
+    Every action must be legal at the start of the round, or this raises
+    before any agent moves.  An earlier move can still make a later one
+    illegal (an agent eaten mid-round respawns at its start), so an agent
+    moved that way whose action is no longer legal stops instead;
+    info['stopped'] lists those agents.
+    """
+    if self.game.gameOver:
+      raise Exception('The game is over; call reset to start a new one')
+    for i in range(self.numAgents):
+      if actions[i] not in self.state.getLegalActions(i):
+        raise Exception('Illegal action %s for agent %d' % (str(actions[i]), i))
+    startPositions = [self.state.getAgentPosition(i) for i in range(self.numAgents)]
+    startScore = self.state.data.score
+    stopped = []
+    for i in range(self.numAgents):
+      action = actions[self.agentIndex]
+      if self.state.getAgentPosition(self.agentIndex) != startPositions[self.agentIndex] and \
+         action not in self.state.getLegalActions(self.agentIndex):
+        action = Directions.STOP
+        stopped.append(self.agentIndex)
+      self.state = self.state.generateSuccessor(self.agentIndex, action)
+      self.game.state = self.state
+      self.game.moveHistory.append((self.agentIndex, action))
+      self.rules.process(self.state, self.game)
+      self.agentIndex = (self.agentIndex + 1) % self.numAgents
+      if self.game.gameOver: break
+    self._observe()
+    scoreChange = self.state.data.score - startScore
+    rewards = [scoreChange if self.state.isOnRedTeam(i) else -scoreChange for i in range(self.numAgents)]
+    info = {'score': self.state.data.score, 'agentIndex': self.agentIndex, 'stopped': stopped}
+    return self.observations, rewards, self.game.gameOver, info
+
+  def _allocate(self, gameLayout):
+    size = gameLayout.width * gameLayout.height
+    if len(self.observations) != self.numAgents or len(self.observations[0]) != NUM_PLANES * size:
+      self.observations = [array.array('h', [0] * (NUM_PLANES * size)) for i in range(self.numAgents)]
+      self._blank = array.array('h', [0] * ((NUM_PLANES - 1) * size))
+    # walls never change, so the other planes are refilled after WALL_PLANE
+    height = gameLayout.height
+    walls = array.array('h', [0] * size)
+    for x, y in gameLayout.walls.asList():
+      walls[x * height + y] = 1
+    for observation in self.observations:
+      observation[:size] = walls
+
+  def _observe(self):
+    state = self.state
+    data = state.data
+    height = data.layout.height
+    size = data.layout.width * height
+    positions = [state.getAgentPosition(i) for i in range(self.numAgents)]
+    for index, observation in enumerate(self.observations):
+      observation[size:] = self._blank
+      isRed = state.teams[index]
+      if isRed: ownFood, enemyFood = data.redFood, data.blueFood
+      else: ownFood, enemyFood = data.blueFood, data.redFood
+      for x, y in ownFood.asList():
+        observation[OWN_FOOD_PLANE * size + x * height + y] = 1
+      for x, y in enemyFood.asList():
+        observation[ENEMY_FOOD_PLANE * size + x * height + y] = 1
+      for x, y in data.capsules:
+        observation[CAPSULE_PLANE * size + x * height + y] = 1
+
+      team = [i for i in range(self.numAgents) if state.teams[i] == isRed]
+      for other, position in enumerate(positions):
+        if position is None: continue
+        if other == index:
+          plane = SELF_PLANE
+        elif state.teams[other] == isRed:
+          plane = TEAMMATE_PLANE
+        else:
+          # as in GameState.makeObservation, opponents out of sight are hidden
+          seen = False
+          for teammate in team:
+            if manhattanDistance(position, positions[teammate]) <= capture.SIGHT_RANGE:
+              seen = True
+          if not seen: continue
+          plane = OPPONENT_PLANE
+        x, y = position
+        cell = x * height + y
+        observation[plane * size + cell] = 1
+        scared = SCARED_PLANE * size + cell
+        observation[scared] = max(observation[scared], data.agentStates[other].scaredTimer)
@@ -110,6 +110,7 @@ class DistanceCalculator:
 def computeDistances(layout):
     "Runs UCS to all other positions from each position"
     distances = {}
+    isWall = layout.walls.isSet
     allNodes = layout.walls.asList(False)
     for source in allNodes:
         dist = {}
@@ -128,13 +129,13 @@ def computeDistances(layout):
             nodeDist = dist[node]
             adjacent = []
             x, y = node
-            if not layout.isWall((x,y+1)):
+            if not isWall(x,y+1):
                 adjacent.append((x,y+1))
-            if not layout.isWall((x,y-1)):
+            if not isWall(x,y-1):
                 adjacent.append((x,y-1) )
-            if not layout.isWall((x+1,y)):
+            if not isWall(x+1,y):
                 adjacent.append((x+1,y) )
-            if not layout.isWall((x-1,y)):
+            if not isWall(x-1,y):
                 adjacent.append((x-1,y))
             for other in adjacent:
                 if not other in dist:
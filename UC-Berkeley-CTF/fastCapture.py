@@ -0,0 +1,529 @@
+# fastCapture.py
+# --------------
+# Licensing Information:  You are free to use or extend these projects for
+# educational purposes provided that (1) you do not distribute or publish
+# solutions, (2) you retain this notice, and (3) you provide clear
+# attribution to UC Berkeley, including a link to http://ai.berkeley.edu.
+#
+# Attribution Information: The Pacman AI projects were developed at UC Berkeley.
+# The core projects and autograders were primarily created by John DeNero
+# (denero@cs.berkeley.edu) and Dan Klein (klein@cs.berkeley.edu).
+# Student side autograding was added by Brad Miller, Nick Hay, and
+# Pieter Abbeel (pabbeel@cs.berkeley.edu).
+
+
+"""
+An opt-in capture engine for training and mass evaluation.
+
+FastCaptureState keeps the whole game in flat buffers indexed by cell
+(x * height + y, the Grid bitboard order): agent positions, directions,
+scared timers and carried/returned counts in arrays, food and capsules in
+bytearrays.  Its moves follow capture.AgentRules exactly, but change the
+buffers in place instead of building agent and configuration objects.
+BatchCaptureGames runs many such games in lockstep for self-play.
+
+capture.GameState stays the reference.  checkAgainstReference replays a
+game through both engines and asserts that they agree after every move;
+run this file to check random games and recorded games:
+
+  python fastCapture.py -l tinyCapture,defaultCapture -n 20
+  python fastCapture.py -r recorded-game.txt
+"""
+
+from game import Actions
+from game import Directions
+import capture
+import util
+import array, random, sys
+
+DIRECTIONS = [Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST, Directions.STOP]
+_DIRECTION_INDEX = dict([(d, i) for i, d in enumerate(DIRECTIONS)])
+_STOP = _DIRECTION_INDEX[Directions.STOP]
+
+# capsule buffer values
+RED_CAPSULE = 1
+BLUE_CAPSULE = 2
+
+class FastCaptureTables:
+  """
+  The parts of a game that never change: the layout's walls and moves, the
+  agents' start cells and the teams.  Every state of a game shares them.
+  """
+
+  def __init__(self, gameState):
+    data = gameState.data
+    layout = data.layout
+    self.layout = layout
+    self.width, self.height = layout.width, layout.height
+    self.halfway = layout.width / 2
+    # cells below this index are on the red side
+    self.redCells = self.halfway * self.height
+    self.walls = bytearray(self.width * self.height)
+    self.legalActions = [None] * (self.width * self.height)
+    self.legalActionIndices = [None] * (self.width * self.height)
+    for (x, y), (actions, neighbors) in Actions.getMoveTable(layout.walls).items():
+      self.legalActions[x * self.height + y] = actions
+      self.legalActionIndices[x * self.height + y] = tuple([_DIRECTION_INDEX[a] for a in actions])
+    for x, y in layout.walls.asList():
+      self.walls[x * self.height + y] = 1
+    self.moves = [1, -1, self.height, -self.height, 0]
+    self.startCells = array.array('i', [self.cell(a.start.pos) for a in data.agentStates])
+    self.startDirections = array.array('b', [_DIRECTION_INDEX[a.start.direction] for a in data.agentStates])
+    self.teams = gameState.teams
+    self.redTeam = gameState.redTeam
+    self.blueTeam = gameState.blueTeam
+    self.opponents = gameState.opponents
+
+  def cell(self, position):
+    x, y = position
+    if x != int(x) or y != int(y):
+      raise ValueError('Agents must be on grid points, not at %s' % str(position))
+    return int(x) * self.height + int(y)
+
+class FastCaptureState:
+  """
+  A capture game state in flat buffers.  Build one from a reference state
+  with fromGameState; apply changes it in place and generateSuccessor
+  returns a changed copy.  The per-move display fields of GameStateData
+  are not kept.
+  """
+
+  def fromGameState(gameState, tables = None):
+    """
+    Copies a capture.GameState whose agents are all on grid points.  Pass
+    the tables of another state of the same game to share them.
+    """
+    if tables is None:
+      tables = FastCaptureTables(gameState)
+    data = gameState.data
+    state = FastCaptureState()
+    state.tables = tables
+    agentStates = data.agentStates
+    state.positions = array.array('i', [tables.cell(a.configuration.pos) for a in agentStates])
+    state.directions = array.array('b', [_DIRECTION_INDEX[a.configuration.direction] for a in agentStates])
+    state.pacman = array.array('b', [int(a.isPacman) for a in agentStates])
+    state.scaredTimers = array.array('i', [a.scaredTimer for a in agentStates])
+    state.carrying = array.array('i', [a.numCarrying for a in agentStates])
+    state.returned = array.array('i', [a.numReturned for a in agentStates])
+    bits = data.food.bits
+    state.food = bytearray([(bits >> cell) & 1 for cell in range(tables.width * tables.height)])
+    state.capsules = bytearray(tables.width * tables.height)
+    for capsule in data.capsules:
+      if capsule in data.redCapsules: owner = RED_CAPSULE
+      else: owner = BLUE_CAPSULE
+      state.capsules[tables.cell(capsule)] = owner
+    state.redFoodCount = data.redFoodCount
+    state.blueFoodCount = data.blueFoodCount
+    state.redCarrying = data.redCarrying
+    state.blueCarrying = data.blueCarrying
+    state.redReturned = data.redReturned
+    state.blueReturned = data.blueReturned
+    state.score = data.score
+    state.timeleft = data.timeleft
+    state.win = data._win
+    state.agentMoved = data._agentMoved
+    return state
+  fromGameState = staticmethod(fromGameState)
+
+  def copy(self):
+    state = FastCaptureState()
+    state.tables = self.tables
+    state.positions = self.positions[:]
+    state.directions = self.directions[:]
+    state.pacman = self.pacman[:]
+    state.scaredTimers = self.scaredTimers[:]
+    state.carrying = self.carrying[:]
+    state.returned = self.returned[:]
+    state.food = self.food[:]
+    state.capsules = self.capsules[:]
+    state.redFoodCount = self.redFoodCount
+    state.blueFoodCount = self.blueFoodCount
+    state.redCarrying = self.redCarrying
+    state.blueCarrying = self.blueCarrying
+    state.redReturned = self.redReturned
+    state.blueReturned = self.blueReturned
+    state.score = self.score
+    state.timeleft = self.timeleft
+    state.win = self.win
+    state.agentMoved = self.agentMoved
+    return state
+
+  def getLegalActions(self, agentIndex):
+    return list(self.tables.legalActions[self.positions[agentIndex]])
+
+  def generateSuccessor(self, agentIndex, action):
+    state = self.copy()
+    state.apply(agentIndex, action)
+    return state
+
+  def getAgentCell(self, agentIndex):
+    return self.positions[agentIndex]
+
+  def getAgentPosition(self, agentIndex):
+    return divmod(self.positions[agentIndex], self.tables.height)
+
+  def getScore(self):
+    return self.score
+
+  def isOver(self):
+    return self.win
+
+  def describe(self):
+    """
+    Returns the state as the tuple describeState gives for the equivalent
+    capture.GameState.
+    """
+    height = self.tables.height
+    agents = tuple([(divmod(self.positions[i], height), DIRECTIONS[self.directions[i]],
+                     bool(self.pacman[i]), self.scaredTimers[i], self.carrying[i], self.returned[i])
+                    for i in range(len(self.positions))])
+    food = 0
+    for cell, hasFood in enumerate(self.food):
+      if hasFood: food |= 1 << cell
+    capsules = tuple(sorted([divmod(cell, height) for cell, owner in enumerate(self.capsules) if owner]))
+    return (agents, food, capsules, self.redFoodCount, self.blueFoodCount,
+            self.redCarrying, self.blueCarrying, self.redReturned, self.blueReturned,
+            self.score, self.timeleft, self.win, self.agentMoved)
+
+  ##################################
+  # The rules, as in AgentRules    #
+  ##################################
+
+  def apply(self, agentIndex, action):
+    """
+    Makes the move in place, like capture.GameState.generateSuccessor.
+    """
+    tables = self.tables
+    cell = self.positions[agentIndex]
+    if action not in tables.legalActions[cell]:
+      raise Exception("Illegal action " + str(action))
+    self.scoreChange = 0
+
+    # Move
+    direction = _DIRECTION_INDEX[action]
+    cell += tables.moves[direction]
+    self.positions[agentIndex] = cell
+    if direction != _STOP:
+      self.directions[agentIndex] = direction
+
+    # Change agent type and bring food home
+    isRed = tables.teams[agentIndex]
+    isPacman = isRed != (cell < tables.redCells)
+    self.pacman[agentIndex] = isPacman
+    numCarrying = self.carrying[agentIndex]
+    if numCarrying > 0 and not isPacman:
+      if isRed:
+        self.scoreChange += numCarrying
+        self.redCarrying -= numCarrying
+        self.redReturned += numCarrying
+      else:
+        self.scoreChange -= numCarrying
+        self.blueCarrying -= numCarrying
+        self.blueReturned += numCarrying
+      self.returned[agentIndex] += numCarrying
+      self.carrying[agentIndex] = 0
+      foodToWin = (capture.TOTAL_FOOD/2) - capture.MIN_FOOD
+      if self.redReturned >= foodToWin or self.blueReturned >= foodToWin:
+        self.win = True
+
+    if isPacman:
+      self.consume(cell, isRed)
+    self.checkDeath(agentIndex)
+    self.scaredTimers[agentIndex] = max(0, self.scaredTimers[agentIndex] - 1)
+
+    # Book keeping
+    self.agentMoved = agentIndex
+    self.score += self.scoreChange
+    self.timeleft -= 1
+
+  def consume(self, cell, isRed):
+    tables = self.tables
+    # Eat food
+    if self.food[cell]:
+      if isRed: team = tables.redTeam
+      else: team = tables.blueTeam
+      for agentIndex in team:
+        if self.positions[agentIndex] == cell:
+          self.carrying[agentIndex] += 1
+          if isRed: self.redCarrying += 1
+          else: self.blueCarrying += 1
+          break
+      self.food[cell] = 0
+      if cell < tables.redCells: self.redFoodCount -= 1
+      else: self.blueFoodCount -= 1
+
+    # Eat capsule
+    if isRed:
+      eaten, otherTeam = BLUE_CAPSULE, tables.blueTeam
+    else:
+      eaten, otherTeam = RED_CAPSULE, tables.redTeam
+    if self.capsules[cell] == eaten:
+      self.capsules[cell] = 0
+      for index in otherTeam:
+        self.scaredTimers[index] = capture.SCARED_TIME
+
+  def checkDeath(self, agentIndex):
+    # Same cell is the only way to be within capture.COLLISION_TOLERANCE on grid points
+    tables = self.tables
+    positions, pacman, scaredTimers = self.positions, self.pacman, self.scaredTimers
+    isRed = tables.teams[agentIndex]
+    if pacman[agentIndex]:
+      for index in tables.opponents[agentIndex]:
+        if pacman[index]: continue
+        if positions[index] == positions[agentIndex]:
+          if scaredTimers[index] <= 0:
+            self.dumpFoodFromDeath(agentIndex)
+            self.killPoints(-1 if isRed else 1)
+            self.respawn(agentIndex)
+          else:
+            self.killPoints(-1 if isRed else 1)
+            self.respawn(index)
+    else:
+      for index in tables.opponents[agentIndex]:
+        if not pacman[index]: continue
+        if positions[index] == positions[agentIndex]:
+          if scaredTimers[agentIndex] <= 0:
+            self.dumpFoodFromDeath(index)
+            self.killPoints(1 if isRed else -1)
+            self.respawn(index)
+          else:
+            self.killPoints(-1 if isRed else 1)
+            self.respawn(agentIndex)
+
+  def killPoints(self, sign):
+    self.scoreChange += sign * capture.KILL_POINTS
+
+  def respawn(self, agentIndex):
+    tables = self.tables
+    self.pacman[agentIndex] = 0
+    self.positions[agentIndex] = tables.startCells[agentIndex]
+    self.directions[agentIndex] = tables.startDirections[agentIndex]
+    self.scaredTimers[agentIndex] = 0
+
+  def dumpFoodFromDeath(self, agentIndex):
+    if not capture.DUMP_FOOD_ON_DEATH:
+      return
+    if not self.pacman[agentIndex]:
+      raise Exception('something is seriously wrong, this agent isnt a pacman!')
+    numCarrying = self.carrying[agentIndex]
+    if numCarrying == 0:
+      return
+
+    tables = self.tables
+    width, height, halfway = tables.width, tables.height, tables.halfway
+    walls, food, capsules = tables.walls, self.food, self.capsules
+    occupied = set(self.positions)
+    x0, y0 = divmod(self.positions[agentIndex], height)
+    isRed = x0 < halfway
+
+    numToDump = numCarrying
+    radius = max(x0, width - x0, y0, height - y0)
+    for dx, dy in capture.foodDumpOffsets(radius):
+      x, y = x0 + dx, y0 + dy
+      if x >= width or y >= height or x <= 0 or y <= 0:
+        continue
+      cell = x * height + y
+      if walls[cell] or food[cell] or capsules[cell]:
+        continue
+      if (x < halfway) != isRed:
+        continue
+      if cell in occupied:
+        continue
+      food[cell] = 1
+      numToDump -= 1
+      if numToDump == 0:
+        break
+    else:
+      raise Exception('Exhausted BFS! uh oh')
+
+    if isRed: self.redFoodCount += numCarrying
+    else: self.blueFoodCount += numCarrying
+    # the agent died on the other team's side, so its own team is not isRed
+    if isRed: self.blueCarrying -= numCarrying
+    else: self.redCarrying -= numCarrying
+    self.carrying[agentIndex] = 0
+
+class BatchCaptureGames:
+  """
+  Plays numGames independent games on one layout in lockstep.  Each step
+  moves the agent whose turn it is in every game, with the actions given
+  as a sequence of indices into DIRECTIONS, one per game.  A game that
+  ends (a team returns enough food, or its length runs out as in
+  CaptureRules.process) is recorded in finalScores and restarted from the
+  initial state, so every step advances numGames live games.
+
+    games = BatchCaptureGames(layout.getLayout('defaultCapture'), 1000)
+    while training:
+      actions = [policy(state, index) for state, index in zip(games.states, games.agentIndices)]
+      scoreChanges, finished = games.step(actions)
+  """
+
+  def __init__(self, layout, numGames, length = capture.MAX_MOVES, numAgents = 4, startingIndex = 0):
+    self.initialState = FastCaptureState.fromGameState(newGameState(layout, numAgents, length))
+    self.numGames = numGames
+    self.numAgents = numAgents
+    self.startingIndex = startingIndex
+    self.scoreChanges = array.array('i', [0] * numGames)
+    self.finished = array.array('b', [0] * numGames)
+    self.finalScores = array.array('i', [0] * numGames)
+    self.gamesPlayed = 0
+    self.reset()
+
+  def reset(self):
+    """
+    Restarts every game.
+    """
+    self.states = [self.initialState.copy() for i in range(self.numGames)]
+    self.agentIndices = array.array('i', [self.startingIndex] * self.numGames)
+
+  def getLegalActions(self):
+    """
+    Returns, for each game, the indices into DIRECTIONS of the legal actions
+    of the agent to move.
+    """
+    legal = self.initialState.tables.legalActionIndices
+    return [legal[state.positions[index]] for state, index in zip(self.states, self.agentIndices)]
+
+  def step(self, actions):
+    """
+    Moves the agent to move in each game, restarting the games that end.
+    Returns two arrays, shared with later steps: the score change of each
+    game's move (positive for red) and whether the game ended on it.
+    Every action is checked before any game moves, so an illegal one
+    raises with the whole batch left as it was.
+    """
+    states, agentIndices, numAgents = self.states, self.agentIndices, self.numAgents
+    scoreChanges, finished = self.scoreChanges, self.finished
+    if len(actions) != self.numGames:
+      raise Exception('Expected %d actions, got %d' % (self.numGames, len(actions)))
+    legal = self.initialState.tables.legalActionIndices
+    for i in xrange(self.numGames):
+      if actions[i] not in legal[states[i].positions[agentIndices[i]]]:
+        raise Exception('Illegal action %s for agent %d in game %d' % (str(actions[i]), agentIndices[i], i))
+    for i in xrange(self.numGames):
+      state = states[i]
+      agentIndex = agentIndices[i]
+      state.apply(agentIndex, DIRECTIONS[actions[i]])
+      scoreChanges[i] = state.scoreChange
+      if state.win or state.timeleft <= 0:
+        finished[i] = 1
+        self.finalScores[i] = state.score
+        self.gamesPlayed += 1
+        states[i] = self.initialState.copy()
+        agentIndices[i] = self.startingIndex
+      else:
+        finished[i] = 0
+        agentIndices[i] = (agentIndex + 1) % numAgents
+    return scoreChanges, finished
+
+def describeState(gameState):
+  """
+  Returns the rule-relevant parts of a capture.GameState as a tuple that
+  can be compared with FastCaptureState.describe.
+  """
+  data = gameState.data
+  agents = tuple([(a.configuration.pos, a.configuration.direction, a.isPacman,
+                   a.scaredTimer, a.numCarrying, a.numReturned) for a in data.agentStates])
+  return (agents, data.food.bits, tuple(sorted(data.capsules)), data.redFoodCount, data.blueFoodCount,
+          data.redCarrying, data.blueCarrying, data.redReturned, data.blueReturned,
+          data.score, data.timeleft, data._win, data._agentMoved)
+
+def newGameState(layout, numAgents, length):
+  """
+  Returns the initial reference state of a game, as CaptureRules.newGame
+  sets it up.
+  """
+  layout.freeze()
+  state = capture.GameState()
+  state.initialize(layout, numAgents)
+  state.data.timeleft = length
+  return state
+
+def checkAgainstReference(gameState, actions = None, length = capture.MAX_MOVES * 4,
+                          startingIndex = 0, rand = random):
+  """
+  Plays a game from gameState through both engines and raises an
+  AssertionError at the first move after which they differ.  actions is a
+  list of (agentIndex, action) pairs such as Game.moveHistory; without
+  it, agents take turns from startingIndex and pick random legal actions
+  for up to length moves.  Returns a util.Counter of the rule events the
+  game went through.
+  """
+  fast = FastCaptureState.fromGameState(gameState)
+  assert fast.describe() == describeState(gameState), 'Initial states differ'
+  if actions is None:
+    actions = randomActions(gameState, length, startingIndex, rand)
+  events = util.Counter()
+  for ply, (agentIndex, action) in enumerate(actions):
+    previous = gameState
+    gameState = gameState.generateSuccessor(agentIndex, action)
+    fast.apply(agentIndex, action)
+    expected = describeState(gameState)
+    found = fast.describe()
+    if found != expected:
+      raise AssertionError('Engines differ after move %d (agent %d, %s):\n  reference %s\n  fast      %s'
+                           % (ply, agentIndex, action, expected, found))
+    countEvents(previous, gameState, events)
+  return events
+
+def randomActions(gameState, length, startingIndex, rand):
+  """
+  Yields random legal moves for the agents in turn, advancing a reference
+  copy of the game as it goes.
+  """
+  agentIndex = startingIndex
+  for i in range(length):
+    if gameState.isOver(): return
+    action = rand.choice(gameState.getLegalActions(agentIndex))
+    gameState = gameState.generateSuccessor(agentIndex, action)
+    yield agentIndex, action
+    agentIndex = (agentIndex + 1) % gameState.getNumAgents()
+
+def countEvents(previous, gameState, events):
+  data = gameState.data
+  events['moves'] += 1
+  if data._foodEaten is not None: events['food eaten'] += 1
+  if data._capsuleEaten is not None: events['capsules eaten'] += 1
+  if data._foodAdded: events['food dumps'] += 1
+  if data.redReturned + data.blueReturned > previous.data.redReturned + previous.data.blueReturned:
+    events['food returned'] += 1
+  for index, agentState in enumerate(data.agentStates):
+    if agentState.configuration is agentState.start and \
+       previous.data.agentStates[index].configuration is not agentState.start:
+      events['deaths'] += 1
+  if gameState.isOver(): events['wins'] += 1
+
+def readCommand(argv):
+  from optparse import OptionParser
+  parser = OptionParser(usage = 'python fastCapture.py <options>')
+  parser.add_option('-l', '--layouts', default = 'tinyCapture,fastCapture,defaultCapture',
+                    help = 'Comma-separated layouts to play random games on [Default: %default]')
+  parser.add_option('-n', '--numGames', type = 'int', default = 10,
+                    help = 'Number of random games per layout [Default: %default]')
+  parser.add_option('-s', '--seed', type = 'int', default = 0,
+                    help = 'Seed for the random games [Default: %default]')
+  parser.add_option('-r', '--replay', action = 'append', default = [],
+                    help = 'A recorded game file to check (may be repeated)')
+  options, otherjunk = parser.parse_args(argv)
+  if len(otherjunk) != 0:
+    raise Exception('Command line input not understood: ' + str(otherjunk))
+  return options
+
+if __name__ == '__main__':
+  import layout, cPickle
+  options = readCommand(sys.argv[1:])
+  total = util.Counter()
+  rand = random.Random(options.seed)
+  for name in options.layouts.split(','):
+    if not name: continue
+    gameLayout = layout.getLayout(name)
+    for i in range(options.numGames):
+      state = newGameState(gameLayout, 4, capture.MAX_MOVES * 4)
+      total += checkAgainstReference(state, startingIndex = i % 2, rand = rand)
+  for fileName in options.replay:
+    recorded = cPickle.load(open(fileName, 'rb'))
+    state = newGameState(recorded['layout'], len(recorded['agents']), recorded['length'])
+    total += checkAgainstReference(state, recorded['actions'])
+  print 'The engines agree. Events checked:'
+  for event in sorted(total.keys()):
+    print '  %-15s %d' % (event, total[event])
@@ -21,7 +21,13 @@
 # For more info, see http://inst.eecs.berkeley.edu/~cs188/sp09/pacman.html
 
 from util import *
-import time, os
+import time, os, random
+import binascii
+import bisect
+import collections
+import gzip
+import itertools
+import math
 import traceback
 import sys
 
@@ -67,19 +73,31 @@ class Directions:
                WEST: EAST,
                STOP: STOP}
 
-class Configuration:
+class Configuration(object):
     """
     A Configuration holds the (x,y) coordinate of a character, along with its
     traveling direction.
 
     The convention for positions, like a graph, is that (0,0) is the lower left corner, x increases
     horizontally and y increases vertically.  Therefore, north is the direction of increasing y, or (0,1).
+
+    Search trees and observation histories hold many of these, so they use
+    __slots__ instead of a per-instance __dict__.
     """
+    __slots__ = ('pos', 'direction')
 
     def __init__(self, pos, direction):
         self.pos = pos
         self.direction = direction
 
+    def __getstate__(self):
+        return (self.pos, self.direction)
+
+    def __setstate__(self, state):
+        if isinstance(state, dict): # pickled before __slots__
+            state = (state['pos'], state['direction'])
+        self.pos, self.direction = state
+
     def getPosition(self):
         return (self.pos)
 
@@ -112,15 +130,18 @@ class Configuration:
         """
         x, y= self.pos
         dx, dy = vector
-        direction = Actions.vectorToDirection(vector)
+        direction = Actions._vectorDirections.get(vector)
+        if direction is None:
+            direction = Actions.vectorToDirection(vector)
         if direction == Directions.STOP:
             direction = self.direction # There is no stop direction
         return Configuration((x + dx, y+dy), direction)
 
-class AgentState:
+class AgentState(object):
     """
     AgentStates hold the state of an agent (configuration, speed, scared, etc).
     """
+    __slots__ = ('start', 'configuration', 'isPacman', 'scaredTimer', 'numCarrying', 'numReturned')
 
     def __init__( self, startConfiguration, isPacman ):
         self.start = startConfiguration
@@ -152,78 +173,145 @@ class AgentState:
         state.numReturned = self.numReturned
         return state
 
+    def __getstate__( self ):
+        return tuple([getattr(self, name) for name in AgentState.__slots__])
+
+    def __setstate__( self, state ):
+        if isinstance(state, dict): # pickled before __slots__
+            state = tuple([state.get(name, 0) for name in AgentState.__slots__])
+        for name, value in zip(AgentState.__slots__, state):
+            setattr(self, name, value)
+
     def getPosition(self):
-        if self.configuration == None: return None
-        return self.configuration.getPosition()
+        if self.configuration is None: return None
+        return self.configuration.pos
 
     def getDirection(self):
         return self.configuration.getDirection()
 
 class Grid:
     """
-    A 2-dimensional array of objects backed by a list of lists.  Data is accessed
-    via grid[x][y] where (x,y) are positions on a Pacman map with x horizontal,
-    y vertical and the origin (0,0) in the bottom left corner.
+    A 2-dimensional array of booleans backed by a single bitboard integer.
+    Data is accessed via grid[x][y] where (x,y) are positions on a Pacman map
+    with x horizontal, y vertical and the origin (0,0) in the bottom left corner.
+
+    Cell (x,y) is stored in bit x * height + y, so columns occupy contiguous
+    runs of bits.  Copies, equality, hashing and counting work on the integer
+    directly instead of visiting every cell.
 
     The __str__ method constructs an output that is oriented like a pacman board.
     """
+    CELLS_PER_INT = 30
+
     def __init__(self, width, height, initialValue=False, bitRepresentation=None):
         if initialValue not in [False, True]: raise Exception('Grids can only contain booleans')
-        self.CELLS_PER_INT = 30
 
         self.width = width
         self.height = height
-        self.data = [[initialValue for y in range(height)] for x in range(width)]
+        self.bits = 0
+        self._columns = None # column lists, built as grid[x] asks for them
+        self._columnBits = None # the bits they were built from
+        if initialValue:
+            self.bits = (1 << (width * height)) - 1
         if bitRepresentation:
             self._unpackBits(bitRepresentation)
 
     def __getitem__(self, i):
-        return self.data[i]
+        columns = self._columns
+        if self._columnBits is not self.bits:
+            columns = self._columns = [None] * self.width
+            self._columnBits = self.bits
+        column = columns[i]
+        if column is None:
+            column = columns[i] = self._makeColumn(i % self.width)
+        return column
+
+    def _makeColumn(self, x):
+        height = self.height
+        pattern = (self.bits >> (x * height)) & ((1 << height) - 1)
+        values = _COLUMN_VALUES.get((height, pattern))
+        if values is None:
+            if len(_COLUMN_VALUES) > 100000: _COLUMN_VALUES.clear()
+            values = _COLUMN_VALUES[(height, pattern)] = tuple([(pattern >> y) & 1 == 1 for y in range(height)])
+        column = _GridColumn(values)
+        column.grid = self
+        column.offset = x * height
+        return column
 
     def __setitem__(self, key, item):
-        self.data[key] = item
+        column = self[key]
+        for y, value in enumerate(item):
+            column[y] = value
 
     def __str__(self):
-        out = [[str(self.data[x][y])[0] for x in range(self.width)] for y in range(self.height)]
+        out = [[str(self[x][y])[0] for x in range(self.width)] for y in range(self.height)]
         out.reverse()
         return '\n'.join([''.join(x) for x in out])
 
     def __eq__(self, other):
         if other == None: return False
-        return self.data == other.data
+        return self.bits == other.bits and self.width == other.width and self.height == other.height
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __hash__(self):
-        # return hash(str(self))
-        base = 1
-        h = 0
-        for l in self.data:
-            for i in l:
-                if i:
-                    h += base
-                base *= 2
-        return hash(h)
+        return hash(self.bits)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_moveTable', None) # rebuilt on demand by Actions.getMoveTable
+        state.pop('_columns', None)
+        state.pop('_columnBits', None)
+        return state
+
+    def __setstate__(self, state):
+        self._columns = None
+        self._columnBits = None
+        # Grids pickled before the bitboard representation stored a list of lists
+        if 'data' in state:
+            data = state.pop('data')
+            state['bits'] = 0
+            self.__dict__.update(state)
+            for x, column in enumerate(data):
+                self[x] = column
+        else:
+            self.__dict__.update(state)
 
     def copy(self):
         g = Grid(self.width, self.height)
-        g.data = [x[:] for x in self.data]
+        g.bits = self.bits
         return g
 
     def deepCopy(self):
         return self.copy()
 
     def shallowCopy(self):
-        g = Grid(self.width, self.height)
-        g.data = self.data
-        return g
+        return self.copy()
+
+    def isSet(self, x, y):
+        """
+        Returns grid[x][y] without building a column view.  Coordinates must
+        be inside the grid.
+        """
+        return (self.bits >> (x * self.height + y)) & 1 == 1
 
     def count(self, item =True ):
-        return sum([x.count(item) for x in self.data])
+        ones = bin(self.bits).count('1')
+        if item: return ones
+        return self.width * self.height - ones
 
     def asList(self, key = True):
+        bits = self.bits
+        if not key:
+            bits = ~bits & ((1 << (self.width * self.height)) - 1)
+        height = self.height
         list = []
-        for x in range(self.width):
-            for y in range(self.height):
-                if self[x][y] == key: list.append( (x,y) )
+        while bits:
+            low = bits & -bits
+            index = low.bit_length() - 1
+            list.append( (index // height, index % height) )
+            bits ^= low
         return list
 
     def packBits(self):
@@ -236,8 +324,7 @@ class Grid:
         currentInt = 0
         for i in range(self.height * self.width):
             bit = self.CELLS_PER_INT - (i % self.CELLS_PER_INT) - 1
-            x, y = self._cellIndexToPosition(i)
-            if self[x][y]:
+            if (self.bits >> i) & 1:
                 currentInt += 2 ** bit
             if (i + 1) % self.CELLS_PER_INT == 0:
                 bits.append(currentInt)
@@ -245,6 +332,14 @@ class Grid:
         bits.append(currentInt)
         return tuple(bits)
 
+    def packBytes(self):
+        """
+        Returns the cells as a byte string of (width * height + 7) / 8 bytes,
+        in bitboard order (big-endian).  See unpackGridBytes.
+        """
+        size = (self.width * self.height + 7) // 8
+        return binascii.unhexlify('%0*x' % (size * 2, self.bits))
+
     def _cellIndexToPosition(self, index):
         x = index / self.height
         y = index % self.height
@@ -258,8 +353,8 @@ class Grid:
         for packed in bits:
             for bit in self._unpackInt(packed, self.CELLS_PER_INT):
                 if cell == self.width * self.height: break
-                x, y = self._cellIndexToPosition(cell)
-                self[x][y] = bit
+                if bit: self.bits |= 1 << cell
+                else: self.bits &= ~(1 << cell)
                 cell += 1
 
     def _unpackInt(self, packed, size):
@@ -274,6 +369,39 @@ class Grid:
                 bools.append(False)
         return bools
 
+# The cell values of every column bit pattern seen so far, by (height, bits)
+_COLUMN_VALUES = {}
+
+class _GridColumn(list):
+    """
+    One column of a Grid as a list of booleans, so that grid[x][y] is a
+    plain list read.  Writes go through to the grid's bits.  A grid rebuilds
+    its columns on the next grid[x] once its bits change, so a column kept
+    from before such a change (other than through the column itself) is
+    out of date.
+    """
+    __slots__ = ('grid', 'offset')
+
+    def __setitem__(self, y, value):
+        if value not in [False, True]: raise Exception('Grids can only contain booleans')
+        list.__setitem__(self, y, value)
+        grid = self.grid
+        current = grid._columnBits is grid.bits and grid._columns[self.offset // grid.height] is self
+        mask = 1 << (self.offset + y % grid.height)
+        if value: grid.bits |= mask
+        else: grid.bits &= ~mask
+        # The cached columns are still current only if they were before and
+        # this column is one of them
+        if current: grid._columnBits = grid.bits
+
+def unpackGridBytes(width, height, packed):
+    """
+    Rebuilds a Grid from the output of Grid.packBytes.
+    """
+    grid = Grid(width, height)
+    grid.bits = int(binascii.hexlify(packed), 16)
+    return grid
+
 def reconstituteGrid(bitRep):
     if type(bitRep) is not type((1,2)):
         return bitRep
@@ -297,6 +425,8 @@ class Actions:
 
     _directionsAsList = _directions.items()
 
+    _vectorDirections = dict([(vec, dir) for dir, vec in _directionsAsList])
+
     TOLERANCE = .001
 
     def reverseDirection(action):
@@ -325,11 +455,46 @@ class Actions:
     vectorToDirection = staticmethod(vectorToDirection)
 
     def directionToVector(direction, speed = 1.0):
+        if speed == 1:
+            # Whole steps keep positions on integers
+            return Actions._directions[direction]
         dx, dy =  Actions._directions[direction]
         return (dx * speed, dy * speed)
     directionToVector = staticmethod(directionToVector)
 
+    def getMoveTable(walls):
+        """
+        Returns a dict from each open cell of walls to a pair
+        (possibleActions, legalNeighbors), in the order getPossibleActions and
+        getLegalNeighbors have always produced them.  The table is built once
+        per walls grid and cached on it; it is rebuilt if the walls change.
+        """
+        cached = walls.__dict__.get('_moveTable')
+        if cached is not None and cached[0] is walls.bits:
+            return cached[1]
+        table = {}
+        for x in range(walls.width):
+            for y in range(walls.height):
+                if walls.isSet(x, y): continue
+                actions = []
+                neighbors = []
+                for dir, vec in Actions._directionsAsList:
+                    dx, dy = vec
+                    next_x, next_y = x + dx, y + dy
+                    if next_x < 0 or next_x >= walls.width or next_y < 0 or next_y >= walls.height: continue
+                    if walls.isSet(next_x, next_y): continue
+                    actions.append(dir)
+                    neighbors.append((next_x, next_y))
+                table[(x, y)] = (tuple(actions), tuple(neighbors))
+        walls._moveTable = (walls.bits, table)
+        return table
+    getMoveTable = staticmethod(getMoveTable)
+
     def getPossibleActions(config, walls):
+        moves = Actions.getMoveTable(walls).get(config.pos)
+        if moves is not None:
+            return list(moves[0])
+
         possible = []
         x, y = config.pos
         x_int, y_int = int(x + 0.5), int(y + 0.5)
@@ -342,13 +507,17 @@ class Actions:
             dx, dy = vec
             next_y = y_int + dy
             next_x = x_int + dx
-            if not walls[next_x][next_y]: possible.append(dir)
+            if not walls.isSet(next_x, next_y): possible.append(dir)
 
         return possible
 
     getPossibleActions = staticmethod(getPossibleActions)
 
     def getLegalNeighbors(position, walls):
+        moves = Actions.getMoveTable(walls).get(position)
+        if moves is not None:
+            return list(moves[1])
+
         x,y = position
         x_int, y_int = int(x + 0.5), int(y + 0.5)
         neighbors = []
@@ -368,18 +537,125 @@ class Actions:
         return (x + dx, y + dy)
     getSuccessor = staticmethod(getSuccessor)
 
+ZOBRIST_SEED = 188 # keys come from private generators, so game randomness is untouched
+
+_zobristKeys = {}
+
+def zobristKey(feature):
+    """
+    Returns the random 64-bit key for a state feature such as
+    ('food', cellIndex).  Keys are seeded by a digest of the feature (see
+    deriveSeed), so they do not depend on the order in which features are
+    first seen, and distinct features whose hash() collides, such as the
+    scores -1 and -2, still get distinct keys.
+    """
+    try:
+        return _zobristKeys[feature]
+    except KeyError:
+        seed = deriveSeed(ZOBRIST_SEED, canonicalFeature(feature))
+        key = _zobristKeys[feature] = random.Random(seed).getrandbits(64)
+        return key
+
+def canonicalFeature(feature):
+    "The feature with whole floats made ints, so features that are equal get one key."
+    if isinstance(feature, tuple):
+        return tuple([canonicalFeature(part) for part in feature])
+    if isinstance(feature, float) and feature == int(feature):
+        return int(feature)
+    return feature
+
+def agentZobristKey(index, agentState):
+    """
+    Returns the key for the position, direction and scared timer of the
+    agent at index: what AgentState.__eq__ compares.
+    """
+    if agentState is None or agentState.configuration is None:
+        return zobristKey(('agent', index, None))
+    conf = agentState.configuration
+    return zobristKey(('position', index, conf.pos)) ^ \
+           zobristKey(('direction', index, conf.direction)) ^ \
+           zobristKey(('scared', index, agentState.scaredTimer))
+
+# Keys of recently seen food bitboards: food changes far less often than
+# the states agents hash
+_foodKeys = {}
+
+def foodZobristKey(bits):
+    """
+    Returns the combined key of the food cells set in a Grid bitboard.
+    """
+    try:
+        return _foodKeys[bits]
+    except KeyError:
+        pass
+    key = 0
+    cells = bits
+    while cells:
+        low = cells & -cells
+        key ^= zobristKey(('food', low.bit_length() - 1))
+        cells ^= low
+    if len(_foodKeys) > 10000: _foodKeys.clear()
+    _foodKeys[bits] = key
+    return key
+
 class GameStateData:
     """
 
     """
-    def __init__( self, prevState = None ):
+    # The log of the moves capture.GameState.apply made in place, whether
+    # the state still owns everything those moves edit (states built from
+    # this one share its objects, so the next apply or undo copies them),
+    # and whether apply is running the rules
+    _undoLog = None
+    _undoOwned = False
+    _applying = False
+
+    def __init__( self, prevState = None, copyOnWrite = False ):
         """
         Generates a new data packet by copying information from its predecessor.
+
+        With copyOnWrite, the food grid, capsule list and agent states are
+        shared with the predecessor and only copied once the rules ask for a
+        mutable version (see getMutableAgentState and getMutableCapsules).
+        Otherwise, as for deepCopy, the new state has its own copies.
         """
+        self._ownedAgents = None
+        self._ownsCapsules = True
+        self._key = None
+        self._agentKeys = None
+        self.redFood = None
+        self.blueFood = None
+        self.redCapsules = None
+        self.blueCapsules = None
+        self.redFoodCount = 0
+        self.blueFoodCount = 0
+        self.redCarrying = 0
+        self.blueCarrying = 0
+        self.redReturned = 0
+        self.blueReturned = 0
         if prevState != None:
-            self.food = prevState.food.shallowCopy()
-            self.capsules = prevState.capsules[:]
-            self.agentStates = self.copyAgentStates( prevState.agentStates )
+            if prevState._undoLog is not None:
+                prevState._undoOwned = False
+            if copyOnWrite:
+                self.food = prevState.food
+                self.agentStates = prevState.agentStates[:]
+                self._ownedAgents = [False] * len(self.agentStates)
+                self.capsules = prevState.capsules
+                self._ownsCapsules = False
+            else:
+                self.food = prevState.food.shallowCopy()
+                self.agentStates = self.copyAgentStates( prevState.agentStates )
+                self.capsules = prevState.capsules[:]
+            self.redFood = prevState.redFood
+            self.blueFood = prevState.blueFood
+            self.redCapsules = prevState.redCapsules
+            self.blueCapsules = prevState.blueCapsules
+            self.redFoodCount = prevState.redFoodCount
+            self.blueFoodCount = prevState.blueFoodCount
+            self.redCarrying = prevState.redCarrying
+            self.blueCarrying = prevState.blueCarrying
+            self.redReturned = prevState.redReturned
+            self.blueReturned = prevState.blueReturned
             self.layout = prevState.layout
             self._eaten = prevState._eaten
             self.score = prevState.score
@@ -395,13 +671,95 @@ class GameStateData:
     def deepCopy( self ):
         state = GameStateData( self )
         state.food = self.food.deepCopy()
+        if self.redFood != None:
+            state.redFood = self.redFood.deepCopy()
+            state.blueFood = self.blueFood.deepCopy()
         state.layout = self.layout.deepCopy()
         state._agentMoved = self._agentMoved
         state._foodEaten = self._foodEaten
         state._foodAdded = self._foodAdded
         state._capsuleEaten = self._capsuleEaten
+        # The key is left to be recomputed: copies are handed to agents,
+        # which may edit them before hashing them
         return state
 
+    def key( self ):
+        """
+        Returns a 64-bit Zobrist key over agent positions, directions and
+        scared timers, the food cells, the capsules and the score: the
+        contents __eq__ compares.  States built by the rules get it
+        incrementally (see updateKey); others, including the copies made by
+        deepCopy and makeObservation, compute it on first use.
+        """
+        if self._key is None:
+            self._agentKeys = [agentZobristKey(i, s) for i, s in enumerate(self.agentStates)]
+            key = zobristKey(('score', self.score)) ^ foodZobristKey(self.food.bits)
+            for agentKey in self._agentKeys:
+                key ^= agentKey
+            for capsule in self.capsules:
+                key ^= zobristKey(('capsule', capsule))
+            self._key = key
+        return self._key
+
+    def updateKey( self, prevState ):
+        """
+        Derives the key from the predecessor's key once the rules have
+        finished editing this state, rehashing only what changed.
+        """
+        key = prevState.key()
+        self.deriveKey( key, prevState._agentKeys, prevState.food, prevState.capsules, prevState.score )
+
+    def deriveKey( self, key, agentKeys, food, capsules, score ):
+        """
+        Like updateKey, but takes the predecessor's key, per-agent keys, food
+        grid, capsule list and score directly.
+        """
+        agentKeys = agentKeys[:]
+        owned = self._ownedAgents
+        for i, agentState in enumerate(self.agentStates):
+            if owned is not None and not owned[i]: continue
+            agentKey = agentZobristKey(i, agentState)
+            key ^= agentKeys[i] ^ agentKey
+            agentKeys[i] = agentKey
+        if self.food is not food:
+            key ^= foodZobristKey(self.food.bits ^ food.bits)
+        if self.capsules is not capsules:
+            for capsule in set(self.capsules).symmetric_difference(capsules):
+                key ^= zobristKey(('capsule', capsule))
+        if self.score != score:
+            key ^= zobristKey(('score', score)) ^ zobristKey(('score', self.score))
+        self._key = key
+        self._agentKeys = agentKeys
+
+    def getMutableAgentState( self, index ):
+        """
+        Returns the agent state at index, copying it first if it is still
+        shared with the predecessor.  During capture.GameState.apply the
+        state owns its agents, so instead the agent's fields and key are
+        logged, once per move, and the agent is edited in place.
+        """
+        owned = self._ownedAgents
+        if owned is not None and not owned[index]:
+            owned[index] = True
+            if not self._applying:
+                self.agentStates[index] = self.agentStates[index].copy()
+            else:
+                agentState = self.agentStates[index]
+                self._undoLog.append(('agent', index, agentState.configuration, agentState.isPacman,
+                                      agentState.scaredTimer, agentState.numCarrying, agentState.numReturned,
+                                      self._agentKeys[index]))
+        return self.agentStates[index]
+
+    def getMutableCapsules( self ):
+        """
+        Returns the capsule list, copying it first if it is still shared with
+        the predecessor.
+        """
+        if not self._ownsCapsules:
+            self.capsules = self.capsules[:]
+            self._ownsCapsules = True
+        return self.capsules
+
     def copyAgentStates( self, agentStates ):
         copiedStates = []
         for agentState in agentStates:
@@ -416,25 +774,22 @@ class GameStateData:
         # TODO Check for type of other
         if not self.agentStates == other.agentStates: return False
         if not self.food == other.food: return False
-        if not self.capsules == other.capsules: return False
+        if self.capsules is not other.capsules and set(self.capsules) != set(other.capsules): return False
         if not self.score == other.score: return False
         return True
 
     def __hash__( self ):
         """
-        Allows states to be keys of dictionaries.
+        Allows states to be keys of dictionaries.  The key is cached, so
+        editing a state's agents, food or capsules directly once it has
+        been hashed leaves its hash (and its successors' keys) stale; the
+        rules keep it up to date for the states they build.
         """
-        for i, state in enumerate( self.agentStates ):
-            try:
-                int(hash(state))
-            except TypeError, e:
-                print e
-                #hash(state)
-        return int((hash(tuple(self.agentStates)) + 13*hash(self.food) + 113* hash(tuple(self.capsules)) + 7 * hash(self.score)) % 1048575 )
+        return hash(self.key())
 
     def __str__( self ):
         width, height = self.layout.width, self.layout.height
-        map = Grid(width, height)
+        map = [[None for y in range(height)] for x in range(width)]
         if type(self.food) == type((1,2)):
             self.food = reconstituteGrid(self.food)
         for x in range(width):
@@ -455,7 +810,9 @@ class GameStateData:
         for x, y in self.capsules:
             map[x][y] = 'o'
 
-        return str(map) + ("\nScore: %d\n" % self.score)
+        out = [''.join([map[x][y] for x in range(width)]) for y in range(height)]
+        out.reverse()
+        return '\n'.join(out) + ("\nScore: %d\n" % self.score)
 
     def _foodWallStr( self, hasFood, hasWall ):
         if hasFood:
@@ -504,18 +861,274 @@ class GameStateData:
             self.agentStates.append( AgentState( Configuration( pos, Directions.STOP), isPacman) )
         self._eaten = [False for a in self.agentStates]
 
+class EventBus:
+    """
+    Passes the events a game's rules publish to subscribed listeners, and
+    keeps the last capacity of them in a ring buffer for readers that poll:
+
+      bus = EventBus()
+      seen = bus.getPublishedCount()
+      ...
+      for event in bus.getEventsSince(seen): ...
+    """
+    def __init__( self, capacity = 4096 ):
+        self.events = collections.deque(maxlen = capacity)
+        self.published = 0
+        self.listeners = []
+
+    def subscribe( self, listener ):
+        "Calls listener(event) for every event published from now on."
+        self.listeners.append(listener)
+
+    def unsubscribe( self, listener ):
+        self.listeners.remove(listener)
+
+    def publish( self, event ):
+        self.events.append(event)
+        self.published += 1
+        for listener in self.listeners:
+            listener(event)
+
+    def getPublishedCount( self ):
+        return self.published
+
+    def getEventsSince( self, count ):
+        """
+        Returns the events published after the first count, leaving out any
+        that have already dropped out of the buffer.
+        """
+        start = max(0, len(self.events) - (self.published - count))
+        return list(itertools.islice(self.events, start, None))
+
+class PhaseTimes:
+    """
+    The time Game.run spends in each phase of every ply, kept per agent:
+    building the agent's observation, its getAction, generateSuccessor,
+    display.update and rules.process.  The durations are counted into fixed
+    log-scale buckets, so memory stays bounded however many games are
+    added up, and getSummary works the percentiles out from the buckets.
+    """
+    PHASES = ('observation', 'getAction', 'generateSuccessor', 'display', 'process')
+
+    # Each power of two from 2**MIN_EXPONENT to 2**MAX_EXPONENT seconds (about
+    # a nanosecond to four and a half hours) is split into BUCKETS_PER_OCTAVE
+    # equal buckets, so a percentile is within 1/BUCKETS_PER_OCTAVE of the truth
+    MIN_EXPONENT = -30
+    MAX_EXPONENT = 14
+    BUCKETS_PER_OCTAVE = 8
+    NUM_BUCKETS = (MAX_EXPONENT - MIN_EXPONENT) * BUCKETS_PER_OCTAVE
+    LIMITS = [math.ldexp(1.0 + (i % BUCKETS_PER_OCTAVE + 1.0) / BUCKETS_PER_OCTAVE, i // BUCKETS_PER_OCTAVE + MIN_EXPONENT)
+              for i in range(NUM_BUCKETS)]
+
+    # How many plies of clock readings an agent keeps before bucketing them
+    MAX_PENDING_PLIES = 1024
+
+    def __init__( self, numAgents ):
+        self.numAgents = numAgents
+        numPhases = len(self.PHASES)
+        # counts[agent][phase][bucket], with the exact totals and maxima beside
+        self.counts = [[[0] * self.NUM_BUCKETS for phase in range(numPhases)] for i in range(numAgents)]
+        self.totals = [[0.0] * numPhases for i in range(numAgents)]
+        self.maxima = [[0.0] * numPhases for i in range(numAgents)]
+        # The raw clock readings of each agent's plies not yet bucketed; see record
+        self.readings = [[] for i in range(numAgents)]
+
+    def record( self, agentIndex, times ):
+        """
+        Records one ply of agentIndex from the len(PHASES) + 1 clock readings
+        taken at the start of each phase and the end of the last.  To keep
+        this cheap, the readings are only bucketed once MAX_PENDING_PLIES of
+        them have built up, or when the times are added or summarized.
+        """
+        readings = self.readings[agentIndex]
+        readings.extend(times)
+        if len(readings) >= self.MAX_PENDING_PLIES * (len(self.PHASES) + 1):
+            self._bucket(agentIndex)
+
+    def _bucket( self, agentIndex ):
+        "Moves agentIndex's pending clock readings into its buckets."
+        readings = self.readings[agentIndex]
+        counts, totals, maxima = self.counts[agentIndex], self.totals[agentIndex], self.maxima[agentIndex]
+        limits, last = self.LIMITS, self.NUM_BUCKETS - 1
+        step = len(self.PHASES) + 1
+        for phase in range(len(self.PHASES)):
+            phaseCounts = counts[phase]
+            durations = [readings[i + 1] - readings[i] for i in range(phase, len(readings), step)]
+            for duration in durations:
+                phaseCounts[min(bisect.bisect_left(limits, duration), last)] += 1
+            if durations:
+                totals[phase] += sum(durations)
+                maxima[phase] = max(maxima[phase], max(durations))
+        del readings[:]
+
+    def bucketIndex( cls, seconds ):
+        "The bucket a duration falls in; durations out of range go in the first or last."
+        return min(bisect.bisect_left(cls.LIMITS, seconds), cls.NUM_BUCKETS - 1)
+    bucketIndex = classmethod(bucketIndex)
+
+    def bucketLimit( cls, index ):
+        "The upper end in seconds of a bucket."
+        return cls.LIMITS[index]
+    bucketLimit = classmethod(bucketLimit)
+
+    def add( self, other ):
+        "Adds the samples of another PhaseTimes, e.g. to sum up several games."
+        for i in range(other.numAgents):
+            other._bucket(i)
+        for i in range(min(self.numAgents, other.numAgents)):
+            for phase in range(len(self.PHASES)):
+                mine, theirs = self.counts[i][phase], other.counts[i][phase]
+                for bucket, count in enumerate(theirs):
+                    if count:
+                        mine[bucket] += count
+                self.totals[i][phase] += other.totals[i][phase]
+                self.maxima[i][phase] = max(self.maxima[i][phase], other.maxima[i][phase])
+
+    def getSummary( self ):
+        """
+        Returns {phase: {'all': stats, agentIndex: stats, ...}}, where stats
+        holds the count and total of the samples in seconds, and their p50,
+        p95, p99 and max.  The percentiles are the upper ends of the buckets
+        they fall in, capped at the max, which is exact.
+        """
+        for i in range(self.numAgents):
+            self._bucket(i)
+        summary = {}
+        for phase, name in enumerate(self.PHASES):
+            summary[name] = {}
+            for i in range(self.numAgents):
+                summary[name][i] = self.summarizeBuckets(self.counts[i][phase], self.totals[i][phase], self.maxima[i][phase])
+            allCounts = [sum(counts) for counts in zip(*[self.counts[i][phase] for i in range(self.numAgents)])]
+            summary[name]['all'] = self.summarizeBuckets(allCounts,
+                                                         sum([self.totals[i][phase] for i in range(self.numAgents)]),
+                                                         max([self.maxima[i][phase] for i in range(self.numAgents)] + [0.0]))
+        return summary
+
+    def summarizeBuckets( cls, counts, total, maximum ):
+        "The count, total, nearest-rank percentiles and max of one list of bucket counts."
+        n = sum(counts)
+        stats = {'count': n, 'total': total, 'max': maximum}
+        for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            stats[name] = 0.0
+            rank = max(1, int(math.ceil(fraction * n)))
+            seen = 0
+            for bucket, count in enumerate(counts):
+                seen += count
+                if n and seen >= rank:
+                    stats[name] = min(cls.bucketLimit(bucket), maximum)
+                    break
+        return stats
+    summarizeBuckets = classmethod(summarizeBuckets)
+
+class AgentOutput:
+    """
+    Where Game.mute sends an agent's stdout and stderr.  Only the last limit
+    bytes are kept in memory: all of them when limit is None, none when it
+    is 0.  Given a logPath, everything the agent writes also goes to that
+    file, gzipped, which is created on the first write and finished by
+    close.
+    """
+    # The limit Game uses for agents whose output is logged, when none is given
+    LOGGED_LIMIT = 64 * 1024
+
+    def __init__( self, limit = None, logPath = None ):
+        self.limit = limit
+        self.logPath = logPath
+        self.log = None
+        self.chunks = collections.deque()
+        self.size = 0
+        self.written = 0
+
+    def write( self, text ):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        self.written += len(text)
+        if self.logPath is not None:
+            if self.log is None:
+                self.log = gzip.open(self.logPath, 'wb')
+            self.log.write(text)
+        limit = self.limit
+        if limit == 0 or not text:
+            return
+        if limit is not None and len(text) >= limit:
+            self.chunks.clear()
+            text = text[-limit:]
+            self.size = 0
+        self.chunks.append(text)
+        self.size += len(text)
+        if limit is None:
+            return
+        # Drop the oldest output beyond the limit
+        while self.size > limit:
+            excess = self.size - limit
+            oldest = self.chunks[0]
+            if len(oldest) <= excess:
+                self.chunks.popleft()
+                self.size -= len(oldest)
+            else:
+                self.chunks[0] = oldest[excess:]
+                self.size -= excess
+
+    def writelines( self, lines ):
+        for line in lines:
+            self.write(line)
+
+    def flush( self ):
+        pass
+
+    def isatty( self ):
+        return False
+
+    def getvalue( self ):
+        "The output kept in memory, as with a StringIO."
+        return ''.join(self.chunks)
+
+    def getDroppedCount( self ):
+        "How many bytes of output have been discarded from memory."
+        return self.written - self.size
+
+    def close( self ):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
 try:
     import boinc
     _BOINC_ENABLED = True
 except:
     _BOINC_ENABLED = False
 
+class AgentDispatch:
+    """
+    The calls Game.run makes to one agent, resolved once per game: which of
+    the optional agent methods it has, its time limits, and the
+    TimeoutFunctions that enforce them.
+    """
+    def __init__( self, agent, agentIndex, rules ):
+        self.registerInitialState = getattr( agent, 'registerInitialState', None )
+        self.final = getattr( agent, 'final', None )
+        self.getAction = agent.getAction
+        # The observation callable, or None to hand the agent a copy of the state
+        self.observe = getattr( agent, 'observationFunction', None )
+        self.usesDeltas = self.observe is not None and getattr( agent, 'useDeltaObservations', False )
+        if self.usesDeltas:
+            self.observe = agent.observeDeltas
+
+        self.moveTimeout = int(rules.getMoveTimeout(agentIndex))
+        self.moveWarningTime = rules.getMoveWarningTime(agentIndex)
+        self.maxTimeWarnings = rules.getMaxTimeWarnings(agentIndex)
+        self.maxTotalTime = rules.getMaxTotalTime(agentIndex)
+        self.observeTimer = None
+        if self.observe is not None:
+            self.observeTimer = TimeoutFunction(self.observe, self.moveTimeout)
+        self.actionTimer = TimeoutFunction(self.getAction, self.moveTimeout)
+
 class Game:
     """
     The Game manages the control flow, soliciting actions from agents.
     """
 
-    def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False ):
+    def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False, timePhases=False, outputLimit=None, outputLog=None ):
         self.agentCrashed = False
         self.agents = agents
         self.display = display
@@ -528,8 +1141,22 @@ class Game:
         self.totalAgentTimes = [0 for agent in agents]
         self.totalAgentTimeWarnings = [0 for agent in agents]
         self.agentTimeout = False
-        import cStringIO
-        self.agentOutput = [cStringIO.StringIO() for agent in agents]
+        # Per-ply phase timings (see PhaseTimes), when timePhases is set
+        self.phaseTimes = None
+        if timePhases:
+            self.phaseTimes = PhaseTimes(len(agents))
+        # Muted agents' output, bounded by outputLimit (see AgentOutput) and
+        # logged to outputLog-agent<index>.txt.gz when outputLog is given.
+        # With a log, only the last AgentOutput.LOGGED_LIMIT bytes stay in
+        # memory unless outputLimit says otherwise.
+        if outputLimit is None and outputLog is None:
+            import cStringIO
+            self.agentOutput = [cStringIO.StringIO() for agent in agents]
+        else:
+            if outputLimit is None:
+                outputLimit = AgentOutput.LOGGED_LIMIT
+            self.agentOutput = [AgentOutput(outputLimit, outputLog and '%s-agent%d.txt.gz' % (outputLog, i))
+                                for i in range(len(agents))]
 
     def getProgress(self):
         if self.gameOver:
@@ -568,11 +1195,19 @@ class Game:
         """
         Main control loop for game play.
         """
+        try:
+            self._run()
+        finally:
+            for output in self.agentOutput:
+                if isinstance(output, AgentOutput): output.close()
+
+    def _run( self ):
         self.display.initialize(self.state.data)
         self.numMoves = 0
 
         ###self.display.initialize(self.state.makeObservation(1).data)
         # inform learning agents of the game start
+        self.dispatch = []
         for i in range(len(self.agents)):
             agent = self.agents[i]
             if not agent:
@@ -583,11 +1218,13 @@ class Game:
                 self.unmute()
                 self._agentCrash(i, quiet=True)
                 return
-            if ("registerInitialState" in dir(agent)):
+            dispatch = AgentDispatch(agent, i, self.rules)
+            self.dispatch.append(dispatch)
+            if dispatch.registerInitialState is not None:
                 self.mute(i)
                 if self.catchExceptions:
                     try:
-                        timed_func = TimeoutFunction(agent.registerInitialState, int(self.rules.getMaxStartupTime(i)))
+                        timed_func = TimeoutFunction(dispatch.registerInitialState, int(self.rules.getMaxStartupTime(i)))
                         try:
                             start_time = time.time()
                             timed_func(self.state.deepCopy())
@@ -604,27 +1241,42 @@ class Game:
                         self.unmute()
                         return
                 else:
-                    agent.registerInitialState(self.state.deepCopy())
+                    dispatch.registerInitialState(self.state.deepCopy())
                 ## TODO: could this exceed the total time
                 self.unmute()
 
         agentIndex = self.startingIndex
         numAgents = len( self.agents )
+        # Moves since each delta-observing agent's last turn (see GameState.getDelta)
+        self.deltas = None
+        if [dispatch for dispatch in self.dispatch if dispatch.usesDeltas]:
+            self.deltas = []
+            self.deltasSeen = [0 for agent in self.agents]
+        phaseTimes = self.phaseTimes
+        clock = time.time
 
         while not self.gameOver:
             # Fetch the next agent
-            agent = self.agents[agentIndex]
+            dispatch = self.dispatch[agentIndex]
             move_time = 0
             skip_action = False
+            if phaseTimes is not None:
+                times = [clock()]
             # Generate an observation of the state
-            if 'observationFunction' in dir( agent ):
+            if dispatch.observe is not None:
+                if dispatch.usesDeltas:
+                    # The agent brings its own copy of the state up to date
+                    observed = self.deltas[self.deltasSeen[agentIndex]:]
+                    self.deltasSeen[agentIndex] = len( self.deltas )
+                else:
+                    observed = self.state.deepCopy()
                 self.mute(agentIndex)
                 if self.catchExceptions:
                     try:
-                        timed_func = TimeoutFunction(agent.observationFunction, int(self.rules.getMoveTimeout(agentIndex)))
+                        timed_func = dispatch.observeTimer
                         try:
                             start_time = time.time()
-                            observation = timed_func(self.state.deepCopy())
+                            observation = timed_func(observed)
                         except TimeoutFunctionException:
                             skip_action = True
                         move_time += time.time() - start_time
@@ -634,17 +1286,20 @@ class Game:
                         self.unmute()
                         return
                 else:
-                    observation = agent.observationFunction(self.state.deepCopy())
+                    observation = dispatch.observe(observed)
                 self.unmute()
             else:
                 observation = self.state.deepCopy()
 
             # Solicit an action
+            if phaseTimes is not None:
+                times.append(clock())
             action = None
             self.mute(agentIndex)
             if self.catchExceptions:
                 try:
-                    timed_func = TimeoutFunction(agent.getAction, int(self.rules.getMoveTimeout(agentIndex)) - int(move_time))
+                    timed_func = dispatch.actionTimer
+                    timed_func.timeout = dispatch.moveTimeout - int(move_time)
                     try:
                         start_time = time.time()
                         if skip_action:
@@ -659,10 +1314,10 @@ class Game:
 
                     move_time += time.time() - start_time
 
-                    if move_time > self.rules.getMoveWarningTime(agentIndex):
+                    if move_time > dispatch.moveWarningTime:
                         self.totalAgentTimeWarnings[agentIndex] += 1
                         print >>sys.stderr, "Agent %d took too long to make a move! This is warning %d" % (agentIndex, self.totalAgentTimeWarnings[agentIndex])
-                        if self.totalAgentTimeWarnings[agentIndex] > self.rules.getMaxTimeWarnings(agentIndex):
+                        if self.totalAgentTimeWarnings[agentIndex] > dispatch.maxTimeWarnings:
                             print >>sys.stderr, "Agent %d exceeded the maximum number of warnings: %d" % (agentIndex, self.totalAgentTimeWarnings[agentIndex])
                             self.agentTimeout = True
                             self._agentCrash(agentIndex, quiet=True)
@@ -671,7 +1326,7 @@ class Game:
 
                     self.totalAgentTimes[agentIndex] += move_time
                     #print "Agent: %d, time: %f, total: %f" % (agentIndex, move_time, self.totalAgentTimes[agentIndex])
-                    if self.totalAgentTimes[agentIndex] > self.rules.getMaxTotalTime(agentIndex):
+                    if self.totalAgentTimes[agentIndex] > dispatch.maxTotalTime:
                         print >>sys.stderr, "Agent %d ran out of time! (time: %1.2f)" % (agentIndex, self.totalAgentTimes[agentIndex])
                         self.agentTimeout = True
                         self._agentCrash(agentIndex, quiet=True)
@@ -683,10 +1338,12 @@ class Game:
                     self.unmute()
                     return
             else:
-                action = agent.getAction(observation)
+                action = dispatch.getAction(observation)
             self.unmute()
 
             # Execute the action
+            if phaseTimes is not None:
+                times.append(clock())
             self.moveHistory.append( (agentIndex, action) )
             if self.catchExceptions:
                 try:
@@ -698,14 +1355,23 @@ class Game:
                     return
             else:
                 self.state = self.state.generateSuccessor( agentIndex, action )
+            if phaseTimes is not None:
+                times.append(clock())
 
             # Change the display
             self.display.update( self.state.data )
+            if phaseTimes is not None:
+                times.append(clock())
             ###idx = agentIndex - agentIndex % 2 + 1
             ###self.display.update( self.state.makeObservation(idx).data )
 
             # Allow for game specific conditions (winning, losing, etc.)
             self.rules.process(self.state, self)
+            if phaseTimes is not None:
+                times.append(clock())
+                phaseTimes.record(agentIndex, times)
+            if self.deltas is not None:
+                self.deltas.append( self.state.getDelta() )
             # Track progress
             if agentIndex == numAgents + 1: self.numMoves += 1
             # Next agent
@@ -715,11 +1381,11 @@ class Game:
                 boinc.set_fraction_done(self.getProgress())
 
         # inform a learning agent of the game result
-        for agentIndex, agent in enumerate(self.agents):
-            if "final" in dir( agent ) :
+        for agentIndex, dispatch in enumerate(self.dispatch):
+            if dispatch.final is not None:
                 try:
                     self.mute(agentIndex)
-                    agent.final( self.state )
+                    dispatch.final( self.state )
                     self.unmute()
                 except Exception,data:
                     if not self.catchExceptions: raise
@@ -16,12 +16,17 @@ from util import manhattanDistance
 from game import Grid
 import os
 import random
+import hashlib
 
 VISIBILITY_MATRIX_CACHE = {}
 
 class Layout:
     """
     A Layout manages the static information about the game board.
+
+    Once a game starts its layout is frozen (see freeze): the instance is
+    then shared by every state, observation and copy of that game instead of
+    being rebuilt from the layout text.
     """
 
     def __init__(self, layoutText):
@@ -37,6 +42,34 @@ class Layout:
         self.totalFood = len(self.food.asList())
         # self.initializeVisibilityMatrix()
 
+    def __setattr__(self, name, value):
+        if self.__dict__.get('frozen', False):
+            raise AttributeError("Can't set attribute %s of a frozen layout" % name)
+        self.__dict__[name] = value
+
+    def freeze(self):
+        """
+        Makes the layout immutable, so deepCopy can return it as is.  Its
+        attributes can no longer be reassigned, and its grids and lists
+        must be treated as read-only.  Freezing a frozen layout does nothing.
+        """
+        if not self.isFrozen():
+            self.__dict__['_digest'] = self.getDigest()
+        self.__dict__['frozen'] = True
+        return self
+
+    def isFrozen(self):
+        return self.__dict__.get('frozen', False)
+
+    def getDigest(self):
+        """
+        Returns a 20-byte digest of the layout text, which identifies the
+        map in serialized game states.  A frozen layout computes it once.
+        """
+        digest = self.__dict__.get('_digest')
+        if digest is not None: return digest
+        return hashlib.sha1('\n'.join(self.layoutText)).digest()
+
     def getNumGhosts(self):
         return self.numGhosts
 
@@ -63,7 +96,7 @@ class Layout:
 
     def isWall(self, pos):
         x, col = pos
-        return self.walls[x][col]
+        return self.walls.isSet(x, col)
 
     def getRandomLegalPosition(self):
         x = random.choice(range(self.width))
@@ -90,6 +123,8 @@ class Layout:
         return "\n".join(self.layoutText)
 
     def deepCopy(self):
+        if self.isFrozen():
+            return self
         return Layout(self.layoutText[:])
 
     def processLayoutText(self, layoutText):
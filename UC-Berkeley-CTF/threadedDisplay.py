@@ -0,0 +1,191 @@
+# threadedDisplay.py
+# ------------------
+# Licensing Information:  You are free to use or extend these projects for
+# educational purposes provided that (1) you do not distribute or publish
+# solutions, (2) you retain this notice, and (3) you provide clear
+# attribution to UC Berkeley, including a link to http://ai.berkeley.edu.
+#
+# Attribution Information: The Pacman AI projects were developed at UC Berkeley.
+# The core projects and autograders were primarily created by John DeNero
+# (denero@cs.berkeley.edu) and Dan Klein (klein@cs.berkeley.edu).
+# Student side autograding was added by Brad Miller, Nick Hay, and
+# Pieter Abbeel (pabbeel@cs.berkeley.edu).
+
+
+"""
+Runs a display on its own thread, so the game does not wait for it:
+
+  display = ThreadedDisplay(captureGraphicsDisplay.PacmanGraphics('Red', 'Blue'))
+
+Game.run hands it a copy of the state after every move, which a render
+thread passes on to the wrapped display.  When the display falls behind,
+frames it has not started on are dropped and the next one it draws
+catches up on everything they changed.
+"""
+
+import collections
+import copy
+import sys
+import threading
+
+class ThreadedDisplay:
+  """
+  Wraps a display whose update draws the changes one move made (the
+  _agentMoved, _foodEaten, _capsuleEaten and _foodAdded of the state), such
+  as captureGraphicsDisplay.PacmanGraphics.  Every call to the display,
+  including the ones agents make through debugDraw, runs on the render
+  thread, so a Tk display is only ever used from that thread.  Calls
+  other than initialize, update and finish return None.  Other attributes,
+  such as the redTeam and blueTeam names, are read from and set on the
+  wrapped display.
+  """
+
+  _OWN_ATTRIBUTES = ('display', 'maxFrames', 'pending', 'condition', 'busy', 'error',
+                     'frameNumber', 'droppedFrames', 'thread')
+
+  def __init__(self, display, maxFrames = 2):
+    self.display = display
+    self.maxFrames = maxFrames
+    self.pending = collections.deque() # ('frame', number, data) or ('call', name, args, kwargs)
+    self.condition = threading.Condition()
+    self.busy = False
+    self.error = None
+    self.frameNumber = 0
+    self.droppedFrames = 0
+    self.thread = threading.Thread(target = self._render, name = 'ThreadedDisplay')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def initialize(self, state, isBlue = False):
+    self.frameNumber = 0
+    self._push(('call', 'initialize', (snapshot(state), isBlue), {}))
+
+  def update(self, state):
+    """
+    Queues a copy of the state.  If maxFrames frames are already waiting,
+    the newest of them is dropped first.
+    """
+    self.frameNumber += 1
+    frame = ('frame', self.frameNumber, snapshot(state))
+    self.condition.acquire()
+    try:
+      self._checkError()
+      frames = [i for i, item in enumerate(self.pending) if item[0] == 'frame']
+      if len(frames) >= self.maxFrames:
+        del self.pending[frames[-1]]
+        self.droppedFrames += 1
+      self.pending.append(frame)
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def finish(self):
+    "Waits for everything queued, and the wrapped display's finish, to be drawn."
+    self._push(('call', 'finish', (), {}))
+    self.condition.acquire()
+    try:
+      while (self.pending or self.busy) and self.error is None:
+        self.condition.wait(0.1)
+      self._checkError()
+    finally:
+      self.condition.release()
+
+  def __getattr__(self, name):
+    attribute = getattr(self.display, name)
+    if not callable(attribute):
+      return attribute
+    def call(*args, **kwargs):
+      self._push(('call', name, args, kwargs))
+    return call
+
+  def __setattr__(self, name, value):
+    if name in ThreadedDisplay._OWN_ATTRIBUTES:
+      self.__dict__[name] = value
+    else:
+      setattr(self.display, name, value)
+
+  def _push(self, item):
+    self.condition.acquire()
+    try:
+      self._checkError()
+      self.pending.append(item)
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def _checkError(self):
+    "Re-raises, in the game's thread, an exception the display raised."
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error[0], error[1], error[2]
+
+  def _render(self):
+    drawn = None # the last state the display was brought up to date with
+    drawnNumber = 0
+    while True:
+      self.condition.acquire()
+      try:
+        while not self.pending:
+          self.condition.wait()
+        item = self.pending.popleft()
+        self.busy = True
+      finally:
+        self.condition.release()
+
+      try:
+        if item[0] == 'frame':
+          kind, number, data = item
+          if drawn is None or number == drawnNumber + 1:
+            self.display.update(data)
+          else:
+            for frame in catchUpFrames(drawn, data):
+              self.display.update(frame)
+          drawn, drawnNumber = data, number
+        else:
+          kind, name, args, kwargs = item
+          getattr(self.display, name)(*args, **kwargs)
+          if name == 'initialize':
+            drawn, drawnNumber = args[0], 0
+      except BaseException:
+        # SystemExit too: closing a Tk window ends the game as before
+        self.condition.acquire()
+        self.error = sys.exc_info()
+        self.pending.clear()
+        self.condition.release()
+
+      self.condition.acquire()
+      self.busy = False
+      self.condition.notifyAll()
+      self.condition.release()
+
+def snapshot(data):
+  "A copy of a GameStateData that later moves will not change."
+  state = data.deepCopy()
+  for name in ('timeleft', '_win', '_lose', 'scoreChange'):
+    if name in data.__dict__:
+      state.__dict__[name] = data.__dict__[name]
+  return state
+
+def catchUpFrames(drawn, data):
+  """
+  Splits the change from drawn to data into one-move frames for update:
+  one per agent, carrying between them the food eaten and added and the
+  capsules eaten since drawn.
+  """
+  drawnFood, food = set(drawn.food.asList()), set(data.food.asList())
+  eaten = sorted(drawnFood - food)
+  added = sorted(food - drawnFood)
+  capsulesEaten = sorted(set(drawn.capsules) - set(data.capsules))
+  numAgents = len(data.agentStates)
+  frames = []
+  for i in range(max(numAgents, len(eaten), len(capsulesEaten))):
+    frame = copy.copy(data)
+    frame._agentMoved = i % numAgents
+    frame._foodEaten = None
+    frame._capsuleEaten = None
+    frame._foodAdded = None
+    if i < len(eaten): frame._foodEaten = eaten[i]
+    if i < len(capsulesEaten): frame._capsuleEaten = capsulesEaten[i]
+    if i == 0 and added: frame._foodAdded = added
+    frames.append(frame)
+  return frames
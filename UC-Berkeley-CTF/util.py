@@ -15,6 +15,7 @@
 import sys
 import inspect
 import heapq, random
+import hashlib
 import cStringIO
 
 
@@ -497,6 +498,19 @@ def getProbability(value, distribution, values):
             total += prob
     return total
 
+def deriveSeed( seed, *names ):
+    """
+    A seed for the random stream called names, derived from a master seed.
+    It is the same in every process and on every platform, so games seeded
+    from one master seed replay identically wherever they run.
+    """
+    digest = hashlib.sha1(repr((seed,) + names)).hexdigest()
+    return int(digest[:16], 16)
+
+def randomStream( seed, *names ):
+    "A random.Random seeded with deriveSeed(seed, *names)."
+    return random.Random(deriveSeed(seed, *names))
+
 def flipCoin( p ):
     r = random.random()
     return r < p
@@ -516,6 +530,8 @@ def nearestPoint( pos ):
     Finds the nearest grid point to a position (discretizes).
     """
     ( current_row, current_col ) = pos
+    if type( current_row ) is int and type( current_col ) is int:
+        return ( current_row, current_col )
 
     grid_row = int( current_row + 0.5 )
     grid_col = int( current_col + 0.5 )